@@ -1,107 +1,32 @@
-import json
+"""Searches for the best ans_len_dist_power for an experiment's best checkpoint on the dev set, e.g.
+  python code/ans_len_param_search.py --experiment=baseline --start=0 --end=2
+
+This runs main.py once in ans_len_search mode (see ans_len_search.py), which runs the network once
+and then tries the powers on its outputs, rather than running official_eval for every power.
+"""
+
 import os
 import argparse
 
-import numpy as np
-
 if __name__ == '__main__':
 
     os.chdir(os.path.join(os.path.dirname(__file__), '..'))
     parser = argparse.ArgumentParser()
     parser.add_argument('--experiment')
-    parser.add_argument('--start')
-    parser.add_argument('--end')
-    parser.add_argument('--step')
-    parser.add_argument('--down')
+    parser.add_argument('--start', default='0')
+    parser.add_argument('--end', default='2')
+    parser.add_argument('--grid', default='11', help='Number of evenly spaced powers to try before refining')
+    parser.add_argument('--tol', default='0.01', help='How precisely to find the best power')
+    parser.add_argument('--metric', default='f1', help='f1 or em')
     args = parser.parse_args()
     print args
 
-
-    exp = args.experiment
-    start = float(args.start)
-    end = float(args.end)
-    step = float(args.step)
-    down = float(args.down)
-
-    POWERS=np.arange(start, end+step/2., step)
-    F1 = {}
-    EM = {}
-    best_f1 = 0.0
-    best_em = 0.0
-    #for p in POWERS:
-    #    print 'Testing power={}'.format(p)
-    #    if p not in F1:
-    #        os.system(('python code/main.py --ans_len_dist_power={} '
-    #                   '--mode=official_eval '
-    #                   '--json_in_path=data/dev-v1.1.json '
-    #                   '--ckpt_load_dir=experiments/{}/best_checkpoint')
-    #                   .format(p, exp))
-    #        os.system('python code/evaluate.py data/dev-v1.1.json '
-    #                  'predictions.json > performance.json')
-    #        with open('performance.json', 'r') as f:
-    #            scores = json.load(f)
-    #    F1[p] = scores['f1']
-    #    EM[p] = scores['exact_match']
-    #    if F1[p] > F1[best_f1]:
-    #        best_f1 = p
-    #    if EM[p] > EM[best_em]:
-    #        best_em = p
-    #    print 'Best F1: {} @ {}'.format(F1[best_f1], best_f1)
-    #    print 'Best EM: {} @ {}'.format(EM[best_em], best_em)
-    #with open('f1-1.json', 'w') as f:
-    #    json.dump(F1, f)
-    #with open('em-1.json', 'w') as f:
-    #    json.dump(EM, f)
-
-
-    POWERS=np.arange(best_f1-step+step/down, best_f1+step, step/down)
-    for p in POWERS:
-        print 'Testing power={}'.format(p)
-        if p in F1: continue
-        os.system(('python code/main.py --ans_len_dist_power={} '
-                   '--mode=official_eval '
-                   '--json_in_path=data/dev-v1.1.json '
-                   '--ckpt_load_dir=experiments/{}/best_checkpoint')
-                   .format(p, exp))
-        os.system('python code/evaluate.py data/dev-v1.1.json '
-                  'predictions.json > performance.json')
-        with open('performance.json', 'r') as f:
-            scores = json.load(f)
-        F1[p] = scores['f1']
-        EM[p] = scores['exact_match']
-        if F1[p] > F1[best_f1]:
-            best_f1 = p
-        if EM[p] > EM[best_em]:
-            best_em = p
-        print 'Best F1: {} @ {}'.format(F1[best_f1], best_f1)
-        print 'Best EM: {} @ {}'.format(EM[best_em], best_em)
-    with open('f1-2.json', 'w') as f:
-        json.dump(F1, f)
-    with open('em-2.json', 'w') as f:
-        json.dump(EM, f)
-
-    POWERS=np.arange(best_em-step+step/down, best_em+step, step/down)
-    for p in POWERS:
-        print 'Testing power={}'.format(p)
-        if p in EM: continue
-        os.system(('python code/main.py --ans_len_dist_power={} '
-                   '--mode=official_eval '
-                   '--json_in_path=data/dev-v1.1.json '
-                   '--ckpt_load_dir=experiments/{}/best_checkpoint')
-                   .format(p, exp))
-        os.system('python code/evaluate.py data/dev-v1.1.json '
-                  'predictions.json > performance.json')
-        with open('performance.json', 'r') as f:
-            scores = json.load(f)
-        F1[p] = scores['f1']
-        EM[p] = scores['exact_match']
-        if F1[p] > F1[best_f1]:
-            best_f1 = p
-        if EM[p] > EM[best_em]:
-            best_em = p
-        print 'Best F1: {} @ {}'.format(F1[best_f1], best_f1)
-        print 'Best EM: {} @ {}'.format(EM[best_em], best_em)
-    with open('f1-3.json', 'w') as f:
-        json.dump(F1, f)
-    with open('em-3.json', 'w') as f:
-        json.dump(EM, f)
+    os.system(('python code/main.py --mode=ans_len_search '
+               '--json_in_path=data/dev-v1.1.json '
+               '--tokenization_cache_dir=data/tokenization_cache '
+               '--ckpt_load_dir=experiments/{}/best_checkpoint '
+               '--ans_len_search_min={} --ans_len_search_max={} '
+               '--ans_len_search_grid={} --ans_len_search_tol={} '
+               '--ans_len_search_metric={}')
+               .format(args.experiment, float(args.start), float(args.end),
+                       int(args.grid), float(args.tol), args.metric))
@@ -0,0 +1,258 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This code is required for "ans_len_search" mode in main.py
+It searches for the ans_len_dist_power that gives the best F1 (or EM) on a SQuAD JSON file.
+
+The network is only run once, and the best span of each answer length is found once for every example
+(see span_decoder.best_span_per_length), so each candidate power just picks the best length under its prior.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import math
+import time
+
+import numpy as np
+from nltk.tokenize.moses import MosesDetokenizer
+
+from preprocessing.squad_preprocess import data_from_json
+from official_eval_helper import get_batch_generator, get_answer_text
+from evaluate import f1_score, exact_match_score, metric_max_over_ground_truths
+from span_decoder import best_span_per_length, decode_best_per_length
+
+
+def get_ground_truths(data_filename):
+    """
+    Returns a dictionary mapping each question's uuid to the list of its ground truth answers (strings),
+    from a SQuAD .json file (like dev-v1.1.json).
+    """
+    dataset = data_from_json(data_filename)
+    uuid2truths = {}
+    for article in dataset['data']:
+        for paragraph in article['paragraphs']:
+            for qn in paragraph['qas']:
+                uuid2truths[qn['id']] = [ans['text'] for ans in qn['answers']]
+    return uuid2truths
+
+
+def get_all_prob_dists(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data):
+    """
+    Runs the model over all the examples once, and keeps the start and end distributions.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      word2id: dictionary mapping word (string) to word id (int)
+      qn_uuid_data, context_token_data, qn_token_data: lists, as returned by get_json_data
+
+    Returns:
+      dists: list of (uuids, context_tokens, start_dist, end_dist) tuples, one per batch.
+        start_dist and end_dist are numpy arrays shape (batch_size, padded context length).
+    """
+    dists = []
+    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len, dedup=model.FLAGS.dedup_contexts, sort_by_length=model.FLAGS.bucket_by_length):
+        start_dist, end_dist = model.get_prob_dists(session, batch)
+        dists.append((batch.uuids, batch.context_tokens, start_dist, end_dist))
+    return dists
+
+
+class PowerScorer(object):
+    """
+    Scores the answers given by a QAModel for a given ans_len_dist_power,
+    using the distributions from get_all_prob_dists.
+
+    The prior only depends on the answer length, so the best start for each (example, length) pair
+    is the same for every power. These are found once, and then each power is a single argmax
+    over the lengths (exactly the spans QAModel.decode_spans would give, up to ties).
+
+    Most examples get the same span for nearby powers, so the F1 and EM of each
+    (example, span) pair are cached, and only new spans are detokenized and scored.
+    """
+
+    def __init__(self, model, dists, uuid2truths):
+        """
+        Inputs:
+          model: QAModel (its span_decoder, max answer length and answer-length prior are used)
+          dists: list of (uuids, context_tokens, start_dist, end_dist), from get_all_prob_dists
+          uuid2truths: dictionary mapping uuid to list of ground truth answers, from get_ground_truths
+        """
+        if model.FLAGS.span_decoder == "band":
+            max_answer_len = model.get_max_answer_len()
+        elif model.FLAGS.span_decoder == "dense":
+            max_answer_len = 0 # all lengths
+        else:
+            raise Exception("Unexpected value of FLAGS.span_decoder: %s" % model.FLAGS.span_decoder)
+
+        # Batches can have different padded context lengths, so pad each batch's arrays
+        # to the longest, with a log score of -inf for the lengths it doesn't have
+        per_batch = [best_span_per_length(start_dist, end_dist, max_answer_len) for _, _, start_dist, end_dist in dists]
+        max_len = max([best_starts.shape[1] for best_starts, _ in per_batch]) if per_batch else 0
+        num_examples = sum([best_starts.shape[0] for best_starts, _ in per_batch])
+        self.best_starts = np.zeros((num_examples, max_len), dtype=np.int64) # shape (num_examples, max_len)
+        self.log_best_scores = np.full((num_examples, max_len), -np.inf) # shape (num_examples, max_len)
+        ex_idx = 0
+        for best_starts, best_scores in per_batch:
+            batch_size, batch_max_len = best_starts.shape
+            self.best_starts[ex_idx:ex_idx+batch_size, :batch_max_len] = best_starts
+            with np.errstate(divide='ignore'): # scores of 0 (e.g. padding) become -inf
+                self.log_best_scores[ex_idx:ex_idx+batch_size, :batch_max_len] = np.log(best_scores)
+            ex_idx += batch_size
+        self.uuids = [uuid for uuids, _, _, _ in dists for uuid in uuids]
+        self.context_tokens = [tokens for _, context_tokens, _, _ in dists for tokens in context_tokens]
+
+        self.model = model
+        self.uuid2truths = uuid2truths
+        self.detokenizer = MosesDetokenizer()
+        self.span_scores = {} # maps (uuid, start, end) to (f1, em)
+        self.results = {} # maps power to (f1, em)
+
+    def score_span(self, uuid, context_tokens, start, end):
+        """Returns the (f1, em) of the answer span (start, end) for question uuid"""
+        key = (uuid, start, end)
+        if key not in self.span_scores:
+            answer = get_answer_text(context_tokens, start, end, self.detokenizer)
+            truths = self.uuid2truths[uuid]
+            self.span_scores[key] = (metric_max_over_ground_truths(f1_score, answer, truths),
+                                     metric_max_over_ground_truths(exact_match_score, answer, truths))
+        return self.span_scores[key]
+
+    def score(self, power):
+        """
+        Returns (f1, em), both percentages over all the questions in uuid2truths (like evaluate.py),
+        for the answers decoded with the answer-length prior raised to power.
+        """
+        if power not in self.results:
+            f1 = em = 0.
+            log_ans_len_probs = np.log(self.model.get_ans_len_probs(power))
+            start_pos, end_pos = decode_best_per_length(self.best_starts, self.log_best_scores, log_ans_len_probs)
+            for ex_idx, (start, end) in enumerate(zip(start_pos.tolist(), end_pos.tolist())):
+                ex_f1, ex_em = self.score_span(self.uuids[ex_idx], self.context_tokens[ex_idx], start, end)
+                f1 += ex_f1
+                em += ex_em
+            total = len(self.uuid2truths)
+            self.results[power] = (100. * f1 / total, 100. * em / total)
+        return self.results[power]
+
+
+def golden_section_search(fn, lo, hi, tol):
+    """
+    Finds an x in [lo, hi] that (locally) maximizes fn, to within tol, by golden-section search.
+
+    Inputs:
+      fn: function of one float, returning a float
+      lo, hi: floats. The interval to search.
+      tol: float. Stop when the interval is narrower than this.
+
+    Returns:
+      x: float. The best point evaluated.
+    """
+    inv_phi = (math.sqrt(5) - 1) / 2 # 0.618...
+    a, b = lo, hi
+    c, d = b - inv_phi * (b - a), a + inv_phi * (b - a)
+    fc, fd = fn(c), fn(d)
+    best_x, best_f = (c, fc) if fc >= fd else (d, fd)
+
+    while b - a > tol:
+        if fc >= fd:
+            # The max is in [a, d]; the old c becomes the new d
+            b, d, fd = d, c, fc
+            c = b - inv_phi * (b - a)
+            fc = fn(c)
+            if fc > best_f:
+                best_x, best_f = c, fc
+        else:
+            # The max is in [c, b]; the old d becomes the new c
+            a, c, fc = c, d, fd
+            d = a + inv_phi * (b - a)
+            fd = fn(d)
+            if fd > best_f:
+                best_x, best_f = d, fd
+
+    return best_x
+
+
+def search_ans_len_power(scorer, lo, hi, num_grid, tol, metric="f1"):
+    """
+    Finds the ans_len_dist_power in [lo, hi] with the best score.
+
+    The score is a step function of the power (it only changes when some example's span changes),
+    and needn't be unimodal, so this first evaluates a coarse grid of num_grid powers,
+    then refines around the best one with golden_section_search.
+
+    Inputs:
+      scorer: PowerScorer
+      lo, hi: floats. Range of powers to search.
+      num_grid: int. Number of powers in the coarse grid (at least 2).
+      tol: float. How precisely to find the best power.
+      metric: "f1" or "em". Which score to maximize.
+
+    Returns:
+      best_power: float
+    """
+    if metric not in ["f1", "em"]:
+        raise Exception("Unexpected metric for the answer length power search: %s" % metric)
+    if num_grid < 2:
+        raise Exception("The answer length power search needs a grid of at least 2 powers, not %i" % num_grid)
+    metric_idx = 0 if metric == "f1" else 1
+
+    def objective(power):
+        is_new = power not in scorer.results
+        f1, em = scorer.score(power)
+        if is_new:
+            print "power=%.4f: F1 %.3f, EM %.3f" % (power, f1, em)
+        return (f1, em)[metric_idx]
+
+    step = (hi - lo) / (num_grid - 1)
+    grid = [lo + i * step for i in range(num_grid)]
+    best_grid_power = max(grid, key=objective)
+
+    best_power = golden_section_search(objective, max(lo, best_grid_power - step), min(hi, best_grid_power + step), tol)
+
+    # Keep the grid point if the refinement didn't beat it
+    if objective(best_grid_power) > objective(best_power):
+        best_power = best_grid_power
+    return best_power
+
+
+def ans_len_search(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data, uuid2truths, lo, hi, num_grid, tol, metric):
+    """
+    Runs the model once over the examples, then searches for the best ans_len_dist_power.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      word2id: dictionary mapping word (string) to word id (int)
+      qn_uuid_data, context_token_data, qn_token_data: lists, as returned by get_json_data
+      uuid2truths: dictionary mapping uuid to list of ground truth answers, from get_ground_truths
+      lo, hi, num_grid, tol, metric: see search_ans_len_power
+
+    Returns:
+      best_power: float
+      f1, em: floats. The scores with best_power.
+    """
+    print "Getting start and end distributions for %i examples..." % len(qn_uuid_data)
+    tic = time.time()
+    dists = get_all_prob_dists(session, model, word2id, qn_uuid_data, context_token_data, qn_token_data)
+    print "Got distributions in %.2f seconds" % (time.time() - tic)
+
+    print "Searching for the best ans_len_dist_power in [%g, %g]..." % (lo, hi)
+    tic = time.time()
+    scorer = PowerScorer(model, dists, uuid2truths)
+    best_power = search_ans_len_power(scorer, lo, hi, num_grid, tol, metric)
+    f1, em = scorer.score(best_power)
+    print "Searched %i powers in %.2f seconds" % (len(scorer.results), time.time() - tic)
+
+    return best_power, f1, em
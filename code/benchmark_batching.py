@@ -0,0 +1,115 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file benchmarks the batching modes in data_batcher.py, by timing
+training iterations (or forward passes) of a freshly initialized model.
+
+It takes the same flags as main.py, plus a few of its own, e.g.
+  python code/benchmark_batching.py --bench_num_batches=50 --bench_train=False
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import sys
+import time
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from main import FLAGS, DEFAULT_DATA_DIR
+from qa_model import QAModel
+from vocab import get_glove
+from data_batcher import get_batch_generator
+
+
+tf.app.flags.DEFINE_integer("bench_num_batches", 50, "For benchmark_batching.py, how many batches to time in each batching mode")
+tf.app.flags.DEFINE_bool("bench_train", True, "For benchmark_batching.py, if True time training iterations, otherwise time forward passes only")
+
+
+def time_batches(session, model, batches, num_batches, train, summary_writer):
+    """
+    Runs the model on the first num_batches batches from batches.
+
+    Returns:
+      num_examples: int. Number of examples processed
+      num_padded: int. Number of (padded) context positions processed
+      num_real: int. Number of real (non-pad) context positions processed
+      step_times: list of floats. Time spent in session.run for each batch (not including making the batches)
+      max_batch_tokens: int. The largest number of (padded) context positions in a batch
+    """
+    num_examples, num_padded, num_real, step_times, max_batch_tokens = 0, 0, 0, [], 0
+    for batch_num, batch in enumerate(batches):
+        if batch_num == num_batches:
+            break
+        tic = time.time()
+        if train:
+            model.run_train_iter(session, batch, summary_writer)
+        else:
+            model.get_loss(session, batch)
+        step_times.append(time.time() - tic)
+
+        num_examples += batch.batch_size
+        num_padded += batch.context_mask.size
+        num_real += int(batch.context_mask.sum())
+        max_batch_tokens = max(max_batch_tokens, batch.context_mask.size)
+
+    return num_examples, num_padded, num_real, step_times, max_batch_tokens
+
+
+def main(unused_argv):
+    FLAGS.glove_path = FLAGS.glove_path or os.path.join(DEFAULT_DATA_DIR, "glove.6B.{}d.txt".format(FLAGS.embedding_size))
+    emb_matrix, word2id, id2word = get_glove(FLAGS.glove_path, FLAGS.embedding_size)
+
+    train_context_path = os.path.join(FLAGS.data_dir, "train.context")
+    train_qn_path = os.path.join(FLAGS.data_dir, "train.question")
+    train_ans_path = os.path.join(FLAGS.data_dir, "train.span")
+
+    qa_model = QAModel(FLAGS, id2word, word2id, emb_matrix, train_ans_path)
+
+    # Each mode is a set of keyword arguments for get_batch_generator
+    modes = [
+        ("fixed padding", dict(bucket_by_length=False)),
+        ("bucketed", dict(bucket_by_length=True)),
+        ("bucketed+dedup", dict(bucket_by_length=True, dedup=True)),
+    ]
+    if FLAGS.max_batch_tokens:
+        modes.append(("token budget", dict(bucket_by_length=True, max_batch_tokens=FLAGS.max_batch_tokens)))
+
+    with tf.Session() as sess:
+        sess.run(tf.global_variables_initializer())
+        qa_model.init_embeddings(sess)
+        summary_writer = tf.summary.FileWriter(tempfile.mkdtemp())
+
+        results = []
+        for name, kwargs in modes:
+            print "Timing %i batches with %s..." % (FLAGS.bench_num_batches, name)
+            batches = get_batch_generator(word2id, train_context_path, train_qn_path, train_ans_path, FLAGS.batch_size, context_len=FLAGS.context_len, question_len=FLAGS.question_len, discard_long=True, **kwargs)
+            results.append((name,) + time_batches(sess, qa_model, batches, FLAGS.bench_num_batches, FLAGS.bench_train, summary_writer))
+
+    print "\n%s throughput (%s):" % ("Training" if FLAGS.bench_train else "Forward pass", "batch_size=%i" % FLAGS.batch_size)
+    base_rate = None
+    for name, num_examples, num_padded, num_real, step_times, max_batch_tokens in results:
+        rate = num_examples / sum(step_times)
+        base_rate = base_rate or rate
+        print "  %-15s %7.1f examples/sec (%.2fx)  %i examples  %.1f%% of context positions are padding" % (name, rate, rate / base_rate, num_examples, 100. * (num_padded - num_real) / num_padded)
+        print "  %-15s step time %.3f +/- %.3f secs  max %i padded context tokens per batch" % ("", np.mean(step_times), np.std(step_times), max_batch_tokens)
+
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    tf.app.run()
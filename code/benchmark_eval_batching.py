@@ -0,0 +1,79 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file benchmarks how the official_eval batch generator scales with the number of questions,
+on synthetic data (no model or GloVe needed), e.g.
+  python code/benchmark_eval_batching.py --sizes=10000,100000,1000000
+
+The time per question should stay roughly constant as the number of questions grows.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import time
+import random
+import argparse
+
+from vocab import _START_VOCAB
+from official_eval_helper import get_batch_generator
+
+
+def make_synthetic_data(num_questions, vocab_size, context_len, question_len, qns_per_context=5):
+    """
+    Returns qn_uuid_data, context_token_data, qn_token_data lists like get_json_data's,
+    with num_questions random questions, qns_per_context about each random context.
+    """
+    words = ["w%i" % i for i in range(vocab_size)]
+    qn_uuid_data, context_token_data, qn_token_data = [], [], []
+    for qn_idx in range(num_questions):
+        if qn_idx % qns_per_context == 0:
+            context_tokens = [random.choice(words) for _ in range(random.randint(context_len // 2, context_len))]
+        qn_uuid_data.append("q%i" % qn_idx)
+        context_token_data.append(context_tokens)
+        qn_token_data.append([random.choice(words) for _ in range(random.randint(3, question_len))])
+    return qn_uuid_data, context_token_data, qn_token_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark official_eval_helper.get_batch_generator")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="Comma-separated numbers of questions to time")
+    parser.add_argument("--batch_size", type=int, default=100)
+    parser.add_argument("--context_len", type=int, default=50, help="Max synthetic context length (also the padding length)")
+    parser.add_argument("--question_len", type=int, default=10, help="Max synthetic question length (also the padding length)")
+    parser.add_argument("--vocab_size", type=int, default=1000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    words = list(_START_VOCAB) + ["w%i" % i for i in range(args.vocab_size)]
+    word2id = dict((w, i) for i, w in enumerate(words))
+
+    base_time_per_qn = None
+    for size in [int(s) for s in args.sizes.split(",")]:
+        qn_uuid_data, context_token_data, qn_token_data = make_synthetic_data(size, args.vocab_size, args.context_len, args.question_len)
+
+        tic = time.time()
+        num_questions = 0
+        for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, args.batch_size, args.context_len, args.question_len):
+            num_questions += batch.batch_size
+        elapsed = time.time() - tic
+        assert num_questions == size
+
+        time_per_qn = elapsed / size
+        base_time_per_qn = base_time_per_qn or time_per_qn
+        print "%9i questions: %7.2f seconds, %6.2f us/question (%.2fx the smallest size)" % (size, elapsed, time_per_qn * 1e6, time_per_qn / base_time_per_qn)
+
+
+if __name__ == "__main__":
+    main()
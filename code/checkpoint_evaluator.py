@@ -0,0 +1,129 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This code is required for "evaluator" mode in main.py
+It runs alongside a train mode process (typically with --eval_every=0), watching its train_dir for new checkpoints.
+Each new checkpoint is evaluated on the dev set (and a sample of the train set),
+the scores are written to TensorBoard (in train_dir/eval), and the checkpoint is copied to
+train_dir/best_checkpoint if it has the best dev EM so far.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+import time
+import logging
+
+import tensorflow as tf
+
+from qa_model import write_summary
+
+
+BEST_SCORES_FILENAME = "best_scores.json" # saved in best_checkpoint, so a restarted evaluator remembers the best dev EM
+
+
+def read_best_scores(bestmodel_dir):
+    """Returns the scores dictionary saved by write_best_scores in bestmodel_dir, or None if there isn't one"""
+    path = os.path.join(bestmodel_dir, BEST_SCORES_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_best_scores(bestmodel_dir, scores):
+    """Writes a dictionary of scores for the best checkpoint to bestmodel_dir"""
+    path = os.path.join(bestmodel_dir, BEST_SCORES_FILENAME)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(scores, f, sort_keys=True)
+    os.rename(path + ".tmp", path)
+
+
+def run_evaluator(session, model, train_dir, train_context_path, train_qn_path, train_ans_path, dev_context_path, dev_qn_path, dev_ans_path, poll_secs, timeout_secs):
+    """
+    Evaluates each new checkpoint in train_dir, until no new checkpoint has appeared for timeout_secs.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      train_dir: the training directory to watch
+      {train/dev}_{qn/context/ans}_path: paths to {train/dev}.{context/question/answer} data files
+      poll_secs: int. How often to look for a new checkpoint.
+      timeout_secs: int. Stop when there's been no new checkpoint for this long. 0 means never stop.
+    """
+    bestmodel_dir = os.path.join(train_dir, "best_checkpoint")
+    bestmodel_ckpt_path = os.path.join(bestmodel_dir, "qa_best.ckpt")
+    if not os.path.exists(bestmodel_dir):
+        os.makedirs(bestmodel_dir)
+
+    # Don't replace a better best_checkpoint from before a restart
+    best_scores = read_best_scores(bestmodel_dir)
+    best_dev_em = best_scores["dev_em"] if best_scores else None
+    if best_scores:
+        logging.info("Best checkpoint so far: iter %i, dev EM %f" % (best_scores["global_step"], best_dev_em))
+
+    # Write summaries to their own directory, so TensorBoard shows them as a separate run from the trainer's
+    summary_writer = tf.summary.FileWriter(os.path.join(train_dir, "eval"))
+
+    # The embedding matrix isn't saved in checkpoints, so initialize it once here
+    model.init_embeddings(session)
+
+    last_ckpt_path = None
+    last_ckpt_time = time.time()
+    logging.info("Watching %s for new checkpoints..." % train_dir)
+    while timeout_secs == 0 or time.time() - last_ckpt_time < timeout_secs:
+        ckpt_path = tf.train.latest_checkpoint(train_dir)
+        if ckpt_path is None or ckpt_path == last_ckpt_path:
+            time.sleep(poll_secs)
+            continue
+
+        # The trainer deletes old checkpoints (see FLAGS.keep), so this one may already be gone
+        try:
+            model.saver.restore(session, ckpt_path)
+        except tf.errors.NotFoundError:
+            logging.info("Checkpoint %s was deleted before it could be loaded; skipping it" % ckpt_path)
+            time.sleep(poll_secs)
+            continue
+        last_ckpt_path = ckpt_path
+        last_ckpt_time = time.time()
+        global_step = session.run(model.global_step)
+        logging.info("Evaluating %s (iter %i)..." % (ckpt_path, global_step))
+
+        # Get loss and F1/EM for entire dev set, in one pass
+        dev_loss, dev_f1, dev_em = model.get_dev_loss_f1_em(session, dev_context_path, dev_qn_path, dev_ans_path)
+        logging.info("Iter %d, dev loss: %f" % (global_step, dev_loss))
+        write_summary(dev_loss, "dev/loss", summary_writer, global_step)
+
+        # Get F1/EM on train set
+        train_f1, train_em = model.check_f1_em(session, train_context_path, train_qn_path, train_ans_path, "train", num_samples=1000)
+        logging.info("Iter %d, Train F1 score: %f, Train EM score: %f" % (global_step, train_f1, train_em))
+        write_summary(train_f1, "train/F1", summary_writer, global_step)
+        write_summary(train_em, "train/EM", summary_writer, global_step)
+
+        logging.info("Iter %d, Dev F1 score: %f, Dev EM score: %f" % (global_step, dev_f1, dev_em))
+        write_summary(dev_f1, "dev/F1", summary_writer, global_step)
+        write_summary(dev_em, "dev/EM", summary_writer, global_step)
+        summary_writer.flush()
+
+        # Early stopping based on dev EM, as in QAModel.train
+        if best_dev_em is None or dev_em > best_dev_em:
+            best_dev_em = dev_em
+            logging.info("Saving to %s..." % bestmodel_ckpt_path)
+            model.bestmodel_saver.save(session, bestmodel_ckpt_path, global_step=global_step)
+            write_best_scores(bestmodel_dir, {"global_step": int(global_step), "dev_loss": float(dev_loss), "dev_f1": dev_f1, "dev_em": dev_em})
+
+    logging.info("No new checkpoint for %i seconds; stopping" % timeout_secs)
+    summary_writer.close()
@@ -0,0 +1,100 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains an LRU cache for context encodings (the output of the context LSTM),
+so that when we're asked several questions about the same context
+we only need to encode it once. See QAModel.add_cached_context_feed."""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+def context_key(context_ids):
+    """
+    Returns the cache key for a context.
+
+    Inputs:
+      context_ids: list or numpy array of ints. The (unpadded) word ids of the context.
+    """
+    return hashlib.sha1(np.asarray(context_ids, dtype=np.int32).tostring()).hexdigest()
+
+
+class ContextEncodingCache(object):
+    """
+    A least-recently-used cache mapping context keys (see context_key) to numpy arrays,
+    that holds at most max_bytes of arrays.
+    Safe to use from several threads.
+
+    The cached encodings depend on the model weights,
+    so only use this when the weights don't change (i.e. not while training).
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Inputs:
+          max_bytes: int. Once the cached arrays take up more than this many bytes,
+            the least recently used ones are evicted.
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the array cached for key (marking it as most recently used), or None"""
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Caches the numpy array value for key, then evicts least recently used entries if over max_bytes"""
+        with self._lock:
+            old_value = self._entries.pop(key, None)
+            if old_value is not None:
+                self.num_bytes -= old_value.nbytes
+            self._entries[key] = value
+            self.num_bytes += value.nbytes
+
+            while self.num_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.num_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.num_bytes = 0
+
+    def stats(self):
+        """Returns a string summarizing the cache's size and hit rate, for logging"""
+        lookups = self.hits + self.misses
+        hit_rate = 100. * self.hits / lookups if lookups else 0.
+        return "%i contexts (%.1f MB), %i hits, %i misses (%.1f%% hit rate), %i evictions" % (len(self._entries), self.num_bytes / 2**20, self.hits, self.misses, hit_rate, self.evictions)
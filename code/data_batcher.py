@@ -18,12 +18,17 @@ truncate, pad and process it into batches ready for training"""
 from __future__ import absolute_import
 from __future__ import division
 
+import os
+import sys
 import random
 import time
 import re
+import threading
+import collections
 
 import numpy as np
-from six.moves import xrange
+import six
+from six.moves import xrange, queue
 from vocab import PAD_ID, UNK_ID
 
 
@@ -41,6 +46,13 @@ class Batch(object):
           ans_span: numpy array, shape (batch_size, 2)
           uuid: a list (length batch_size) of strings.
             Not needed for training. Used by official_eval mode.
+
+        If the batch is deduplicated (see dedup_contexts), it also has
+          uniq_context_ids, uniq_context_mask: numpy arrays shape (num_contexts, context_len).
+            The distinct contexts in the batch.
+          context_index: numpy array shape (batch_size).
+            Example i has context uniq_context_ids[context_index[i]].
+        Otherwise these are None.
         """
         self.context_ids = context_ids
         self.context_mask = context_mask
@@ -55,7 +67,11 @@ class Batch(object):
 
         self.uuids = uuids
 
-        self.batch_size = len(self.context_tokens)
+        self.uniq_context_ids = None
+        self.uniq_context_mask = None
+        self.context_index = None
+
+        self.batch_size = len(self.context_ids)
 
 
 def split_by_whitespace(sentence):
@@ -93,18 +109,151 @@ def padded(token_batch, batch_pad=0):
     return map(lambda token_list: token_list + [PAD_ID] * (maxlen - len(token_list)), token_batch)
 
 
-def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long):
+def make_example(word2id, context_line, qn_line, ans_line, context_len, question_len, discard_long):
+    """
+    Makes an example from one line of each of the {train/dev}.{context/question/answer} data files.
+
+    Inputs:
+      word2id: dictionary mapping word (string) to word id (int)
+      context_line, qn_line, ans_line: strings
+      context_len, question_len: max length of context and question respectively
+      discard_long: If True, discard the example if it's longer than context_len or question_len.
+        If False, truncate it instead.
+
+    Returns:
+      (context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens) tuple,
+      or None if the example is discarded.
+    """
+    # Convert tokens to word ids
+    context_tokens, context_ids = sentence_to_token_ids(context_line, word2id)
+    qn_tokens, qn_ids = sentence_to_token_ids(qn_line, word2id)
+    ans_span = intstr_to_intlist(ans_line)
+
+    # get ans_tokens from ans_span
+    assert len(ans_span) == 2
+    if ans_span[1] < ans_span[0]:
+        print "Found an ill-formed gold span: start=%i end=%i" % (ans_span[0], ans_span[1])
+        return None
+    ans_tokens = context_tokens[ans_span[0] : ans_span[1]+1] # list of strings
+
+    # discard or truncate too-long questions
+    if len(qn_ids) > question_len:
+        if discard_long:
+            return None
+        else: # truncate
+            qn_ids = qn_ids[:question_len]
+
+    # discard or truncate too-long contexts
+    if len(context_ids) > context_len:
+        if discard_long:
+            return None
+        else: # truncate
+            context_ids = context_ids[:context_len]
+
+    return (context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens)
+
+
+def examples_to_batch(context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens, context_len, question_len, bucket_by_length, dedup):
+    """
+    Pads a batch of examples and makes it into a Batch object.
+
+    Inputs:
+      context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens: lists length batch_size (see make_example)
+      context_len, question_len: lengths to pad the contexts and questions to
+      bucket_by_length: If True, pad only to the longest context and question in the batch instead.
+      dedup: If True, deduplicate the contexts in the batch (see dedup_contexts).
+    """
+    # Pad context_ids and qn_ids
+    if bucket_by_length:
+        qn_ids = padded(qn_ids) # pad questions to the longest question in the batch
+        context_ids = padded(context_ids) # pad contexts to the longest context in the batch
+    else:
+        qn_ids = padded(qn_ids, question_len) # pad questions to length question_len
+        context_ids = padded(context_ids, context_len) # pad contexts to length context_len
+
+    # Make qn_ids into a np array and create qn_mask
+    qn_ids = np.array(qn_ids) # shape (question_len, batch_size)
+    qn_mask = (qn_ids != PAD_ID).astype(np.int32) # shape (question_len, batch_size)
+
+    # Make context_ids into a np array and create context_mask
+    context_ids = np.array(context_ids) # shape (context_len, batch_size)
+    context_mask = (context_ids != PAD_ID).astype(np.int32) # shape (context_len, batch_size)
+
+    # Make ans_span into a np array
+    ans_span = np.array(ans_span) # shape (batch_size, 2)
+
+    # Make into a Batch object
+    batch = Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens, ans_span, ans_tokens)
+    if dedup:
+        dedup_contexts(batch)
+    return batch
+
+
+def dedup_contexts(batch, context_keys=None):
+    """
+    Finds the distinct contexts in a batch, so that the model only has to encode each of them once.
+    Sets batch.uniq_context_ids, batch.uniq_context_mask and batch.context_index (see Batch).
+
+    Inputs:
+      batch: Batch
+      context_keys: optional numpy array shape (batch_size), of ints that are equal iff
+        the contexts are equal (e.g. context numbers). If None, the context_ids rows are compared.
+    """
+    if context_keys is None:
+        _, first_idxs, context_index = np.unique(batch.context_ids, axis=0, return_index=True, return_inverse=True)
+    else:
+        _, first_idxs, context_index = np.unique(context_keys, return_index=True, return_inverse=True)
+    batch.uniq_context_ids = batch.context_ids[first_idxs]
+    batch.uniq_context_mask = batch.context_mask[first_idxs]
+    batch.context_index = context_index.astype(np.int32)
+
+
+def token_budget_batch_ranges(context_lens, max_batch_tokens):
+    """
+    Greedily splits a list of (sorted) examples into batches such that
+    batch size times padded context length stays within max_batch_tokens.
+
+    Inputs:
+      context_lens: list of ints. The padded context length of each example
+        (i.e. its own length if batches are padded to their max length, otherwise context_len).
+      max_batch_tokens: int. Max (batch size * padded context length) for each batch.
+        A batch always contains at least one example, even if that example alone exceeds the budget.
+
+    Returns:
+      list of (start, end) pairs. Each batch is examples[start:end].
+    """
+    ranges = []
+    batch_start, batch_max_len = 0, 0
+    for idx, length in enumerate(context_lens):
+        new_max_len = max(batch_max_len, length)
+        if idx > batch_start and (idx - batch_start + 1) * new_max_len > max_batch_tokens:
+            ranges.append((batch_start, idx))
+            batch_start, new_max_len = idx, length
+        batch_max_len = new_max_len
+    if batch_start < len(context_lens):
+        ranges.append((batch_start, len(context_lens)))
+    return ranges
+
+
+def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long, bucket_by_length=False, max_batch_tokens=0, group_by_context=False):
     """
     Adds more batches into the "batches" list.
 
     Inputs:
-      batches: list to add batches to
+      batches: list or deque to add batches to
       word2id: dictionary mapping word (string) to word id (int)
       context_file, qn_file, ans_file: paths to {train/dev}.{context/question/answer} data files
       batch_size: int. how big to make the batches
       context_len, question_len: max length of context and question respectively
       discard_long: If True, discard any examples that are longer than context_len or question_len.
         If False, truncate those exmaples instead.
+      bucket_by_length: If True, sort examples by context length (then question length)
+        rather than question length, so that examples in a batch have similar lengths.
+      max_batch_tokens: int. If nonzero, make batches of varying size, filling each batch up to
+        max_batch_tokens (batch size * padded context length), rather than batches of batch_size.
+        batch_size still determines how many examples are read per refill.
+      group_by_context: If True (and bucket_by_length), put questions about the same context
+        next to each other, so that batches contain as few distinct contexts as possible.
     """
     print "Refilling batches..."
     tic = time.time()
@@ -113,37 +262,16 @@ def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size
 
     while context_line and qn_line and ans_line: # while you haven't reached the end
 
-        # Convert tokens to word ids
-        context_tokens, context_ids = sentence_to_token_ids(context_line, word2id)
-        qn_tokens, qn_ids = sentence_to_token_ids(qn_line, word2id)
-        ans_span = intstr_to_intlist(ans_line)
+        # Convert to ids, then discard or truncate too-long examples
+        example = make_example(word2id, context_line, qn_line, ans_line, context_len, question_len, discard_long)
 
         # read the next line from each file
         context_line, qn_line, ans_line = context_file.readline(), qn_file.readline(), ans_file.readline()
 
-        # get ans_tokens from ans_span
-        assert len(ans_span) == 2
-        if ans_span[1] < ans_span[0]:
-            print "Found an ill-formed gold span: start=%i end=%i" % (ans_span[0], ans_span[1])
-            continue
-        ans_tokens = context_tokens[ans_span[0] : ans_span[1]+1] # list of strings
-
-        # discard or truncate too-long questions
-        if len(qn_ids) > question_len:
-            if discard_long:
-                continue
-            else: # truncate
-                qn_ids = qn_ids[:question_len]
-
-        # discard or truncate too-long contexts
-        if len(context_ids) > context_len:
-            if discard_long:
-                continue
-            else: # truncate
-                context_ids = context_ids[:context_len]
-
         # add to examples
-        examples.append((context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens))
+        if example is None:
+            continue
+        examples.append(example)
 
         # stop refilling if you have 160 batches
         if len(examples) == batch_size * 160:
@@ -151,27 +279,47 @@ def refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size
 
     # Once you've either got 160 batches or you've reached end of file:
 
-    # Sort by question length
-    # Note: if you sort by context length, then you'll have batches which contain the same context many times (because each context appears several times, with different questions)
-    examples = sorted(examples, key=lambda e: len(e[2]))
-
-    # Make into batches and append to the list batches
-    for batch_start in xrange(0, len(examples), batch_size):
+    if bucket_by_length and group_by_context:
+        # Sort by context length, then context, then question length
+        # As below, but also groups the questions about each context together
+        examples = sorted(examples, key=lambda e: (len(e[0]), e[0], len(e[2])))
+    elif bucket_by_length:
+        # Sort by context length, then question length
+        # This minimizes padding when each batch is only padded to its own max length
+        examples = sorted(examples, key=lambda e: (len(e[0]), len(e[2])))
+    else:
+        # Sort by question length
+        # Note: if you sort by context length, then you'll have batches which contain the same context many times (because each context appears several times, with different questions)
+        examples = sorted(examples, key=lambda e: len(e[2]))
+
+    # Work out where each batch starts and ends
+    if max_batch_tokens:
+        padded_context_lens = [len(e[0]) if bucket_by_length else context_len for e in examples]
+        batch_ranges = token_budget_batch_ranges(padded_context_lens, max_batch_tokens)
+    else:
+        batch_ranges = [(batch_start, batch_start+batch_size) for batch_start in xrange(0, len(examples), batch_size)]
+
+    # Make into batches
+    new_batches = []
+    for batch_start, batch_end in batch_ranges:
 
         # Note: each of these is a list length batch_size of lists of ints (except on last iter when it might be less than batch_size)
-        context_ids_batch, context_tokens_batch, qn_ids_batch, qn_tokens_batch, ans_span_batch, ans_tokens_batch = zip(*examples[batch_start:batch_start+batch_size])
+        context_ids_batch, context_tokens_batch, qn_ids_batch, qn_tokens_batch, ans_span_batch, ans_tokens_batch = zip(*examples[batch_start:batch_end])
 
-        batches.append((context_ids_batch, context_tokens_batch, qn_ids_batch, qn_tokens_batch, ans_span_batch, ans_tokens_batch))
+        new_batches.append((context_ids_batch, context_tokens_batch, qn_ids_batch, qn_tokens_batch, ans_span_batch, ans_tokens_batch))
 
     # shuffle the batches
-    random.shuffle(batches)
+    random.shuffle(new_batches)
+
+    # Add them to batches
+    batches.extend(new_batches)
 
     toc = time.time()
     print "Refilling batches took %.2f seconds" % (toc-tic)
     return
 
 
-def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long):
+def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, discard_long, bucket_by_length=False, max_batch_tokens=0, dedup=False):
     """
     This function returns a generator object that yields batches.
     The last batch in the dataset will be a partial batch.
@@ -184,37 +332,157 @@ def get_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, co
       context_len, question_len: max length of context and question respectively
       discard_long: If True, discard any examples that are longer than context_len or question_len.
         If False, truncate those exmaples instead.
+      bucket_by_length: If True, group examples of similar length into batches,
+        and pad each batch only to its own max context and question length
+        (rather than to context_len and question_len).
+      max_batch_tokens: int. If nonzero, fill each batch up to this many (padded) context tokens
+        instead of making batches of batch_size. See refill_batches.
+      dedup: If True, deduplicate the contexts in each batch (see dedup_contexts).
+        With bucket_by_length, this also groups questions about the same context into the same batch.
     """
     context_file, qn_file, ans_file = open(context_path), open(qn_path), open(ans_path)
-    batches = []
+    batches = collections.deque() # so that taking the next batch is O(1)
 
     while True:
         if len(batches) == 0: # add more batches
-            refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long)
+            refill_batches(batches, word2id, context_file, qn_file, ans_file, batch_size, context_len, question_len, discard_long, bucket_by_length, max_batch_tokens, group_by_context=dedup)
         if len(batches) == 0:
             break
 
         # Get next batch. These are all lists length batch_size
-        (context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens) = batches.pop(0)
+        (context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens) = batches.popleft()
 
-        # Pad context_ids and qn_ids
-        qn_ids = padded(qn_ids, question_len) # pad questions to length question_len
-        context_ids = padded(context_ids, context_len) # pad contexts to length context_len
+        yield examples_to_batch(context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens, context_len, question_len, bucket_by_length, dedup)
+
+    return
 
-        # Make qn_ids into a np array and create qn_mask
-        qn_ids = np.array(qn_ids) # shape (question_len, batch_size)
-        qn_mask = (qn_ids != PAD_ID).astype(np.int32) # shape (question_len, batch_size)
 
-        # Make context_ids into a np array and create context_mask
-        context_ids = np.array(context_ids) # shape (context_len, batch_size)
-        context_mask = (context_ids != PAD_ID).astype(np.int32) # shape (context_len, batch_size)
+# Maps (path, size, modification time) to the line offsets of that file, so each file is only indexed once
+_line_offsets_cache = {}
 
-        # Make ans_span into a np array
-        ans_span = np.array(ans_span) # shape (batch_size, 2)
 
-        # Make into a Batch object
-        batch = Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens, ans_span, ans_tokens)
+def get_line_offsets(path):
+    """
+    Returns a numpy array of the byte offsets where each line of the file at path starts.
+    The result is cached for as long as the file doesn't change.
+    """
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _line_offsets_cache:
+        offsets = []
+        offset = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                offsets.append(offset)
+                offset += len(line)
+        _line_offsets_cache[key] = np.array(offsets, dtype=np.int64)
+    return _line_offsets_cache[key]
+
+
+def read_lines_at(path, offsets):
+    """Returns the lines of the file at path that start at the given byte offsets (see get_line_offsets)"""
+    lines = []
+    with open(path, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            lines.append(f.readline())
+    return lines
+
+
+def get_sample_batch_generator(word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, num_samples, bucket_by_length=False, dedup=False, rng=np.random):
+    """
+    Like get_batch_generator, but yields batches of num_samples examples chosen uniformly at random
+    from the whole dataset, rather than all of it.
 
-        yield batch
+    Only the sampled lines are read (using an index of where each line starts, see get_line_offsets),
+    so this costs time proportional to num_samples, after the first call for each dataset.
+    Too-long examples are truncated, as with get_batch_generator's discard_long=False.
 
-    return
+    Inputs:
+      word2id, context_path, qn_path, ans_path, batch_size, context_len, question_len, bucket_by_length, dedup:
+        see get_batch_generator
+      num_samples: int. How many examples to sample. If more than the size of the dataset, use all of it.
+      rng: numpy RandomState (or the numpy.random module) to sample with
+    """
+    context_offsets, qn_offsets, ans_offsets = get_line_offsets(context_path), get_line_offsets(qn_path), get_line_offsets(ans_path)
+    num_examples = len(context_offsets)
+    if len(qn_offsets) != num_examples or len(ans_offsets) != num_examples:
+        raise Exception("%s, %s and %s have different numbers of lines" % (context_path, qn_path, ans_path))
+
+    # Read the sampled lines in file order, to keep the seeks short
+    example_idxs = np.sort(rng.choice(num_examples, min(num_samples, num_examples), replace=False))
+    lines = zip(read_lines_at(context_path, context_offsets[example_idxs]), read_lines_at(qn_path, qn_offsets[example_idxs]), read_lines_at(ans_path, ans_offsets[example_idxs]))
+    examples = [make_example(word2id, context_line, qn_line, ans_line, context_len, question_len, discard_long=False) for context_line, qn_line, ans_line in lines]
+    examples = [example for example in examples if example is not None]
+
+    # As in refill_batches, sort by length so batches have little padding
+    if bucket_by_length:
+        examples.sort(key=lambda e: (len(e[0]), e[0], len(e[2])) if dedup else (len(e[0]), len(e[2])))
+
+    for batch_start in xrange(0, len(examples), batch_size):
+        context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens = zip(*examples[batch_start:batch_start+batch_size])
+        yield examples_to_batch(context_ids, context_tokens, qn_ids, qn_tokens, ans_span, ans_tokens, context_len, question_len, bucket_by_length, dedup)
+
+
+class PrefetchingBatchGenerator(object):
+    """
+    Wraps a batch generator so that it runs in a background (producer) thread,
+    keeping up to num_prefetch batches ready in a bounded queue.
+    This means the training loop doesn't wait for e.g. refill_batches,
+    as long as making a batch is quicker than a training iteration.
+
+    Iterate over this object like the generator it wraps,
+    and call close() when you're done with it.
+    """
+
+    def __init__(self, generator, num_prefetch):
+        """
+        Inputs:
+          generator: a batch generator, e.g. from get_batch_generator
+          num_prefetch: int. Max number of batches to keep ready
+        """
+        self._queue = queue.Queue(maxsize=num_prefetch)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(generator,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, generator):
+        """Runs in the producer thread. Puts (batch, exc_info) pairs on the queue; batch is None at the end."""
+        try:
+            for batch in generator:
+                if not self._put((batch, None)):
+                    return
+        except Exception:
+            self._put((None, sys.exc_info()))
+            return
+        self._put((None, None))
+
+    def _put(self, item):
+        """Puts item on the queue, unless close() is called first. Returns False if closed."""
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def close(self):
+        """Stops the producer thread, if it's still running (e.g. if you stop iterating before the end)"""
+        self._stopped.set()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        batch, exc_info = self._queue.get()
+
+        # Re-raise any error from the producer thread here, in the consumer thread
+        if exc_info is not None:
+            six.reraise(*exc_info)
+        if batch is None:
+            raise StopIteration
+        return batch
+
+    __next__ = next
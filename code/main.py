@@ -19,15 +19,22 @@ from __future__ import division
 
 import os
 import io
+import re
 import json
 import sys
 import logging
+import subprocess
+import multiprocessing
 
 import tensorflow as tf
 
-from qa_model import QAModel
-from vocab import get_glove
-from official_eval_helper import get_json_data, generate_answers
+from qa_model import QAModel, write_ans_len_dist
+from vocab import get_glove, get_restricted_words, restrict_vocab, read_vocab, write_vocab
+from official_eval_helper import get_json_data, generate_answers, stream_answers
+from context_cache import ContextEncodingCache
+from serving import serve
+from ans_len_search import get_ground_truths, ans_len_search
+from checkpoint_evaluator import run_evaluator
 
 
 logging.basicConfig(level=logging.INFO)
@@ -35,11 +42,13 @@ logging.basicConfig(level=logging.INFO)
 MAIN_DIR = os.path.relpath(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) # relative path of the main directory
 DEFAULT_DATA_DIR = os.path.join(MAIN_DIR, "data") # relative path of data dir
 EXPERIMENTS_DIR = os.path.join(MAIN_DIR, "experiments") # relative path of experiments dir
+RESTRICTED_VOCAB_FILENAME = "restricted_vocab.txt" # saved in train_dir (and best_checkpoint) if the vocab was restricted
+ANS_LEN_DIST_FILENAME = "ans_len_dist.json" # saved in train_dir (and best_checkpoint), so inference doesn't need train.span
 
 
 # High-level options
 tf.app.flags.DEFINE_integer("gpu", 0, "Which GPU to use, if you have multiple.")
-tf.app.flags.DEFINE_string("mode", "train", "Available modes: train / show_examples / official_eval")
+tf.app.flags.DEFINE_string("mode", "train", "Available modes: train / show_examples / official_eval / serve / ans_len_search / evaluator")
 tf.app.flags.DEFINE_string("experiment_name", "", "Unique name for your experiment. This will create a directory by this name in the experiments/ directory, which will hold all data related to this experiment")
 tf.app.flags.DEFINE_integer("num_epochs", 0, "Number of epochs to train. 0 means train indefinitely")
 
@@ -48,32 +57,101 @@ tf.app.flags.DEFINE_float("learning_rate", 0.001, "Learning rate.")
 tf.app.flags.DEFINE_float("max_gradient_norm", 5.0, "Clip gradients to this norm.")
 tf.app.flags.DEFINE_float("dropout", 0.15, "Fraction of units randomly dropped on non-recurrent connections.")
 tf.app.flags.DEFINE_float("ans_len_dist_power", 1.0, "Power applied to answer len distribution post DL model")
+tf.app.flags.DEFINE_string("span_decoder", "band", "How to pick the answer span from the start/end distributions. Available: band / dense. band only scores spans up to max_answer_len; dense scores every span and is kept as a reference.")
+tf.app.flags.DEFINE_integer("max_answer_len", -1, "For the band span decoder, the longest answer span (in tokens) to consider. -1 means the longest answer in the training set, which gives effectively the same spans as the dense decoder. 0 means no limit, which gives exactly the same spans but is as slow as dense. A smaller limit (e.g. 30) makes decoding faster, but can change the predictions")
+tf.app.flags.DEFINE_bool("decode_in_graph", False, "If True, decode answer spans inside the TensorFlow graph (band decoding, using max_answer_len) and only fetch the spans, instead of fetching the start/end distributions and decoding with span_decoder")
 tf.app.flags.DEFINE_integer("batch_size", 100, "Batch size to use")
 tf.app.flags.DEFINE_integer("preatt_hidden_size", 200, "Size of the pre-attension layer hidden states")
 tf.app.flags.DEFINE_integer("postatt_hidden_size", 200, "Size of the post-attension layer hidden states")
 tf.app.flags.DEFINE_integer("context_len", 600, "The maximum context length of your model")
 tf.app.flags.DEFINE_integer("question_len", 30, "The maximum question length of your model")
+tf.app.flags.DEFINE_bool("bucket_by_length", False, "If True, batch together examples of similar context length and pad each batch only to its own max length, rather than to context_len/question_len. In official_eval mode, this sorts all the examples by length")
+tf.app.flags.DEFINE_integer("max_batch_tokens", 0, "If nonzero, make variable-size batches holding up to this many (batch size * padded context length) tokens, instead of fixed batch_size batches. Works best with bucket_by_length")
+tf.app.flags.DEFINE_bool("dedup_contexts", False, "If True, encode each distinct context in a batch only once. Works best with bucket_by_length, which then also groups questions about the same context into the same batch")
 tf.app.flags.DEFINE_integer("embedding_size", 100, "Size of the pretrained word vectors. This needs to be one of the available GloVe dimensions: 50/100/200/300")
+tf.app.flags.DEFINE_bool("restrict_vocab", False, "For train mode, restrict the vocab (and embedding matrix) to the words seen in the train/dev data. The restricted vocab is saved next to the checkpoints and reused when they are loaded.")
+tf.app.flags.DEFINE_integer("restrict_vocab_top_n", 0, "When restricting the vocab, also keep the N most frequent GloVe words")
 
 # How often to print, save, eval
 tf.app.flags.DEFINE_integer("print_every", 1, "How many iterations to do per print.")
 tf.app.flags.DEFINE_integer("save_every", 500, "How many iterations to do per save.")
-tf.app.flags.DEFINE_integer("eval_every", 500, "How many iterations to do per calculating loss/f1/em on dev set. Warning: this is fairly time-consuming so don't do it too often.")
+tf.app.flags.DEFINE_integer("eval_every", 500, "How many iterations to do per calculating loss/f1/em on dev set. Warning: this is fairly time-consuming so don't do it too often. 0 means never (e.g. when running a separate evaluator mode process)")
+tf.app.flags.DEFINE_integer("eval_poll_secs", 30, "For evaluator mode, how often to look for a new checkpoint in train_dir")
+tf.app.flags.DEFINE_integer("eval_timeout_secs", 0, "For evaluator mode, stop when there's been no new checkpoint for this long. 0 means never stop")
+tf.app.flags.DEFINE_string("cpu_cores", "", "If set, pin this process to these CPU cores (a taskset list like 0-5 or 0,2,4) and size TensorFlow's thread pools to match. Use disjoint sets for the train and evaluator processes")
 tf.app.flags.DEFINE_integer("keep", 1, "How many checkpoints to keep. 0 indicates keep all (you shouldn't need to do keep all though - it's very storage intensive).")
 
 # Reading and saving data
 tf.app.flags.DEFINE_string("train_dir", "", "Training directory to save the model parameters and other info. Defaults to experiments/{experiment_name}")
 tf.app.flags.DEFINE_string("glove_path", "", "Path to glove .txt file. Defaults to data/glove.6B.{embedding_size}d.txt")
 tf.app.flags.DEFINE_string("data_dir", DEFAULT_DATA_DIR, "Where to find preprocessed SQuAD data for training. Defaults to data/")
-tf.app.flags.DEFINE_string("ckpt_load_dir", "", "For official_eval mode, which directory to load the checkpoint fron. You need to specify this for official_eval mode.")
-tf.app.flags.DEFINE_string("json_in_path", "", "For official_eval mode, path to JSON input file. You need to specify this for official_eval_mode.")
+tf.app.flags.DEFINE_bool("packed_data", False, "If True, compile the training set into packed arrays of word ids once (in data_dir/train.packed), and make training batches from those instead of re-reading the text files every epoch")
+tf.app.flags.DEFINE_bool("global_shuffle", False, "If True, shuffle the whole training set every epoch (rather than just within windows of 160 batches). Implies packed_data")
+tf.app.flags.DEFINE_integer("shuffle_seed", 42, "Random seed for global_shuffle. Each epoch's order is determined by the seed and the epoch number")
+tf.app.flags.DEFINE_integer("prefetch_batches", 0, "If nonzero, make training batches in a background thread, keeping up to this many batches ready")
+tf.app.flags.DEFINE_string("ckpt_load_dir", "", "For official_eval, serve and ans_len_search modes, which directory to load the checkpoint fron. You need to specify this for these modes.")
+tf.app.flags.DEFINE_string("json_in_path", "", "For official_eval and ans_len_search modes, path to JSON input file. You need to specify this for these modes. For ans_len_search mode it needs the answers, like dev-v1.1.json")
 tf.app.flags.DEFINE_string("json_out_path", "predictions.json", "Output path for official_eval mode. Defaults to predictions.json")
+tf.app.flags.DEFINE_bool("stream_eval", False, "For official_eval mode, read json_in_path incrementally (it can also be a .jsonl file), tokenize it in worker processes and write each batch of predictions as soon as it's made. Memory use doesn't grow with the input size. If json_out_path ends with .jsonl, writes one prediction per line")
+tf.app.flags.DEFINE_string("tokenization_cache_dir", "", "For official_eval and ans_len_search modes, if set, cache the tokenized json_in_path in this directory, so later runs on the same file skip tokenization")
+tf.app.flags.DEFINE_integer("num_workers", 0, "For official_eval and ans_len_search modes, number of worker processes for tokenizing. 0 means one per CPU. Without stream_eval, 1 means tokenize in the main process")
+tf.app.flags.DEFINE_string("serve_host", "localhost", "For serve mode, the address to listen on")
+tf.app.flags.DEFINE_integer("serve_port", 8000, "For serve mode, the port to listen on")
+tf.app.flags.DEFINE_integer("serve_max_batch_size", 32, "For serve mode, the max number of concurrent requests to run as one batch")
+tf.app.flags.DEFINE_float("serve_max_wait_ms", 5.0, "For serve mode, how long to wait for more requests to fill a batch, after the first request arrives")
+tf.app.flags.DEFINE_float("ans_len_search_min", 0.0, "For ans_len_search mode, the smallest ans_len_dist_power to try")
+tf.app.flags.DEFINE_float("ans_len_search_max", 2.0, "For ans_len_search mode, the largest ans_len_dist_power to try")
+tf.app.flags.DEFINE_integer("ans_len_search_grid", 11, "For ans_len_search mode, how many evenly spaced powers to try before refining around the best one")
+tf.app.flags.DEFINE_float("ans_len_search_tol", 0.01, "For ans_len_search mode, how precisely to find the best power")
+tf.app.flags.DEFINE_string("ans_len_search_metric", "f1", "For ans_len_search mode, which score to maximize. Available: f1 / em")
+tf.app.flags.DEFINE_integer("context_cache_mb", 0, "For official_eval and serve modes, if nonzero, cache up to this many MB of context encodings, so each distinct context is only encoded once")
 
 
 FLAGS = tf.app.flags.FLAGS
 os.environ["CUDA_VISIBLE_DEVICES"] = str(FLAGS.gpu)
 
 
+def parse_cpu_list(cores):
+    """
+    Parses a taskset CPU list like "0-5", "0,2,4" or "0-10:2" (every second core from 0 to 10).
+
+    Inputs:
+      cores: string. The CPU list.
+
+    Returns:
+      core_ids: sorted list of ints, without duplicates.
+    """
+    core_ids = set()
+    for part in cores.split(","):
+        match = re.match(r"^(\d+)(?:-(\d+)(?::(\d+))?)?$", part.strip())
+        if match is None:
+            raise Exception("Invalid CPU list %s: can't parse %s" % (cores, part))
+        first = int(match.group(1))
+        last = int(match.group(2)) if match.group(2) is not None else first
+        stride = int(match.group(3)) if match.group(3) is not None else 1
+        if last < first or stride < 1:
+            raise Exception("Invalid CPU list %s: bad range %s" % (cores, part))
+        core_ids.update(range(first, last + 1, stride))
+    return sorted(core_ids)
+
+
+def pin_to_cores(cores):
+    """
+    Pins this process (all its threads) to the given CPU cores, with taskset.
+
+    Inputs:
+      cores: string. A taskset CPU list, see parse_cpu_list.
+
+    Returns:
+      num_cores: int. How many cores that is.
+    """
+    # Check the list before pinning, so a list we can't count doesn't leave the process half-configured
+    num_cores = len(parse_cpu_list(cores))
+    print "Pinning to %i CPU cores (%s)" % (num_cores, cores)
+    subprocess.check_call(["taskset", "-a", "-pc", cores, str(os.getpid())])
+    return num_cores
+
+
 def initialize_model(session, model, train_dir, expect_exists):
     """
     Initializes model from train_dir.
@@ -99,6 +177,9 @@ def initialize_model(session, model, train_dir, expect_exists):
             session.run(tf.global_variables_initializer())
             print 'Num params: %d' % sum(v.get_shape().num_elements() for v in tf.trainable_variables())
 
+    # The embedding matrix isn't saved in checkpoints, so it's always initialized from the numpy matrix
+    model.init_embeddings(session)
+
 
 def main(unused_argv):
     # Print an error message if you've entered flags incorrectly
@@ -113,7 +194,7 @@ def main(unused_argv):
     print "This code was developed and tested on TensorFlow 1.4.1. Your TensorFlow version: %s" % tf.__version__
 
     # Define train_dir
-    if not FLAGS.experiment_name and not FLAGS.train_dir and FLAGS.mode != "official_eval":
+    if not FLAGS.experiment_name and not FLAGS.train_dir and FLAGS.mode not in ["official_eval", "serve", "ans_len_search"]:
         raise Exception("You need to specify either --experiment_name or --train_dir")
     FLAGS.train_dir = FLAGS.train_dir or os.path.join(EXPERIMENTS_DIR, FLAGS.experiment_name)
 
@@ -134,13 +215,35 @@ def main(unused_argv):
     dev_qn_path = os.path.join(FLAGS.data_dir, "dev.question")
     dev_ans_path = os.path.join(FLAGS.data_dir, "dev.span")
 
+    # If the checkpoint we're going to load was trained with a restricted vocab, use the same vocab.
+    # Otherwise, in train mode, optionally restrict the vocab to the words in the train/dev data.
+    ckpt_dir = {"train": FLAGS.train_dir, "evaluator": FLAGS.train_dir, "official_eval": FLAGS.ckpt_load_dir, "serve": FLAGS.ckpt_load_dir, "ans_len_search": FLAGS.ckpt_load_dir}.get(FLAGS.mode, bestmodel_dir)
+    restricted_vocab_path = os.path.join(ckpt_dir, RESTRICTED_VOCAB_FILENAME)
+    if ckpt_dir and os.path.exists(restricted_vocab_path):
+        print "Restricting vocab to the words in %s" % restricted_vocab_path
+        emb_matrix, word2id, id2word = restrict_vocab(emb_matrix, word2id, read_vocab(restricted_vocab_path))
+    elif FLAGS.mode == "train" and FLAGS.restrict_vocab:
+        print "Restricting vocab to the words in the train/dev data..."
+        restricted_words = get_restricted_words(word2id, [train_context_path, train_qn_path, dev_context_path, dev_qn_path], FLAGS.restrict_vocab_top_n)
+        emb_matrix, word2id, id2word = restrict_vocab(emb_matrix, word2id, restricted_words)
+    print "Vocab size: %i" % len(word2id)
+
     # Initialize model
-    qa_model = QAModel(FLAGS, id2word, word2id, emb_matrix, train_ans_path)
+    # (it reads the answer length distribution saved with the checkpoint, if there is one, otherwise train.span)
+    ans_len_dist_path = os.path.join(ckpt_dir, ANS_LEN_DIST_FILENAME) if ckpt_dir else ""
+    qa_model = QAModel(FLAGS, id2word, word2id, emb_matrix, train_ans_path, ans_len_dist_path)
 
     # Some GPU settings
     config=tf.ConfigProto()
     config.gpu_options.allow_growth = True
 
+    # Optionally pin to some CPU cores (e.g. so that train and evaluator processes don't compete for them)
+    # Do this before the session starts its threads, and don't start more threads than there are cores
+    if FLAGS.cpu_cores:
+        num_cores = pin_to_cores(FLAGS.cpu_cores)
+        config.intra_op_parallelism_threads = num_cores
+        config.inter_op_parallelism_threads = num_cores
+
     # Split by mode
     if FLAGS.mode == "train":
 
@@ -158,6 +261,15 @@ def main(unused_argv):
         if not os.path.exists(bestmodel_dir):
             os.makedirs(bestmodel_dir)
 
+        # Save the restricted vocab (if any) alongside the checkpoints
+        if FLAGS.restrict_vocab or os.path.exists(restricted_vocab_path):
+            for vocab_dir in [FLAGS.train_dir, bestmodel_dir]:
+                write_vocab(id2word, os.path.join(vocab_dir, RESTRICTED_VOCAB_FILENAME))
+
+        # Save the answer length distribution alongside the checkpoints
+        for ans_len_dir in [FLAGS.train_dir, bestmodel_dir]:
+            write_ans_len_dist(qa_model.train_ans_len_dist, os.path.join(ans_len_dir, ANS_LEN_DIST_FILENAME))
+
         with tf.Session(config=config) as sess:
 
             # Load most recent model
@@ -183,23 +295,98 @@ def main(unused_argv):
         if FLAGS.ckpt_load_dir == "":
             raise Exception("For official_eval mode, you need to specify --ckpt_load_dir")
 
-        # Read the JSON data from file
-        qn_uuid_data, context_token_data, qn_token_data = get_json_data(FLAGS.json_in_path)
+        if FLAGS.stream_eval:
+            # Start the tokenizer processes before the session (and its threads) exist
+            pool = multiprocessing.Pool(FLAGS.num_workers or None)
+
+            with tf.Session(config=config) as sess:
+                initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+                if FLAGS.context_cache_mb:
+                    qa_model.context_cache = ContextEncodingCache(FLAGS.context_cache_mb * 2**20)
+
+                stream_answers(sess, qa_model, word2id, FLAGS.json_in_path, FLAGS.json_out_path, pool)
+                if qa_model.context_cache is not None:
+                    print "Context encoding cache: %s" % qa_model.context_cache.stats()
+
+            pool.close()
+            pool.join()
+
+        else:
+            # Read the JSON data from file, tokenizing in worker processes
+            pool = multiprocessing.Pool(FLAGS.num_workers or None) if FLAGS.num_workers != 1 else None
+            qn_uuid_data, context_token_data, qn_token_data = get_json_data(FLAGS.json_in_path, pool, FLAGS.tokenization_cache_dir)
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            with tf.Session(config=config) as sess:
+
+                # Load model from ckpt_load_dir
+                initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+                if FLAGS.context_cache_mb:
+                    qa_model.context_cache = ContextEncodingCache(FLAGS.context_cache_mb * 2**20)
+
+                # Get a predicted answer for each example in the data
+                # Return a mapping answers_dict from uuid to answer
+                answers_dict = generate_answers(sess, qa_model, word2id, qn_uuid_data, context_token_data, qn_token_data)
+                if qa_model.context_cache is not None:
+                    print "Context encoding cache: %s" % qa_model.context_cache.stats()
+
+                # Write the uuid->answer mapping a to json file in root dir
+                print "Writing predictions to %s..." % FLAGS.json_out_path
+                with io.open(FLAGS.json_out_path, 'w', encoding='utf-8') as f:
+                    f.write(unicode(json.dumps(answers_dict, ensure_ascii=False)))
+                    print "Wrote predictions to %s" % FLAGS.json_out_path
+
+
+    elif FLAGS.mode == "serve":
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For serve mode, you need to specify --ckpt_load_dir")
 
         with tf.Session(config=config) as sess:
 
             # Load model from ckpt_load_dir
             initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+            if FLAGS.context_cache_mb:
+                qa_model.context_cache = ContextEncodingCache(FLAGS.context_cache_mb * 2**20)
+
+            # Answer requests until interrupted
+            serve(sess, qa_model, word2id, FLAGS.serve_host, FLAGS.serve_port, FLAGS.serve_max_batch_size, FLAGS.serve_max_wait_ms)
+
 
-            # Get a predicted answer for each example in the data
-            # Return a mapping answers_dict from uuid to answer
-            answers_dict = generate_answers(sess, qa_model, word2id, qn_uuid_data, context_token_data, qn_token_data)
+    elif FLAGS.mode == "ans_len_search":
+        if FLAGS.json_in_path == "":
+            raise Exception("For ans_len_search mode, you need to specify --json_in_path")
+        if FLAGS.ckpt_load_dir == "":
+            raise Exception("For ans_len_search mode, you need to specify --ckpt_load_dir")
+
+        # Read the JSON data (and its answers) from file, tokenizing in worker processes
+        pool = multiprocessing.Pool(FLAGS.num_workers or None) if FLAGS.num_workers != 1 else None
+        qn_uuid_data, context_token_data, qn_token_data = get_json_data(FLAGS.json_in_path, pool, FLAGS.tokenization_cache_dir)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        uuid2truths = get_ground_truths(FLAGS.json_in_path)
+
+        with tf.Session(config=config) as sess:
+
+            # Load model from ckpt_load_dir
+            initialize_model(sess, qa_model, FLAGS.ckpt_load_dir, expect_exists=True)
+
+            # Run the model once, then try different powers on its outputs
+            best_power, f1, em = ans_len_search(sess, qa_model, word2id, qn_uuid_data, context_token_data, qn_token_data, uuid2truths,
+                    FLAGS.ans_len_search_min, FLAGS.ans_len_search_max, FLAGS.ans_len_search_grid, FLAGS.ans_len_search_tol, FLAGS.ans_len_search_metric)
+            print "Best ans_len_dist_power: %.4f (F1 %.3f, EM %.3f)" % (best_power, f1, em)
+
+
+    elif FLAGS.mode == "evaluator":
+        if not os.path.exists(FLAGS.train_dir):
+            raise Exception("Training directory %s does not exist" % FLAGS.train_dir)
+
+        with tf.Session(config=config) as sess:
 
-            # Write the uuid->answer mapping a to json file in root dir
-            print "Writing predictions to %s..." % FLAGS.json_out_path
-            with io.open(FLAGS.json_out_path, 'w', encoding='utf-8') as f:
-                f.write(unicode(json.dumps(answers_dict, ensure_ascii=False)))
-                print "Wrote predictions to %s" % FLAGS.json_out_path
+            # Evaluate each new checkpoint the trainer saves, and keep the best one
+            run_evaluator(sess, qa_model, FLAGS.train_dir, train_context_path, train_qn_path, train_ans_path, dev_context_path, dev_qn_path, dev_ans_path, FLAGS.eval_poll_secs, FLAGS.eval_timeout_secs)
 
 
     else:
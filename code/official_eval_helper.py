@@ -20,85 +20,75 @@ from __future__ import absolute_import
 from __future__ import division
 
 import os
+import io
+import re
+import json
+import time
+import hashlib
+import itertools
 from tqdm import tqdm
 import numpy as np
+import nltk
 from six.moves import xrange
 from nltk.tokenize.moses import MosesDetokenizer
 
 from preprocessing.squad_preprocess import data_from_json, tokenize
 from vocab import UNK_ID, PAD_ID
-from data_batcher import padded, Batch
+from data_batcher import padded, Batch, dedup_contexts
 
+# Bump this whenever tokenize_context or squad_preprocess.tokenize changes, so that cached tokenizations are invalidated
+TOKENIZER_VERSION = "1-nltk%s" % nltk.__version__
 
 
-def readnext(x):
-    """x is a list"""
-    if len(x) == 0:
-        return False
-    else:
-        return x.pop(0)
-
-
-
-def refill_batches(batches, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len):
+def make_batch(word2id, uuids, context_tokens, qn_tokens, context_len, question_len, pad_to_batch_max=False, dedup=False):
     """
-    This is similar to refill_batches in data_batcher.py, but:
-      (1) instead of reading from (preprocessed) datafiles, it reads from the provided lists
-      (2) it only puts the context and question information in the batches (not the answer information)
-      (3) it also gets UUID information and puts it in the batches
+    Makes a Batch (without answer information) from tokenized contexts and questions.
 
     Inputs:
-      batches: list to be refilled
-      qn_uuid_data: list of strings that are unique ids
-      context_token_data, qn_token_data: list of lists of strings (no UNKs, no padding)
-      batch_size: int. size of batches to make
+      word2id: dictionary mapping word (string) to word id (int)
+      uuids: list of strings that are unique ids
+      context_tokens, qn_tokens: lists (same length as uuids) of lists of strings (no UNKs, no padding)
       context_len, question_len: ints. max sizes of context and question. Anything longer is truncated.
+      pad_to_batch_max: If True, pad to the longest context and question in the batch,
+        rather than to context_len and question_len.
+      dedup: If True, deduplicate the contexts in the batch (see data_batcher.dedup_contexts).
 
-    Makes batches that contain:
-      uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch: all lists length batch_size
+    Returns:
+      Batch
     """
-    examples = []
+    # Convert context_tokens and qn_tokens to context_ids and qn_ids
+    # Note: truncating context_ids may truncate the correct answer, meaning that it's impossible for your model to get the correct answer on this example!
+    context_ids = [[word2id.get(w, UNK_ID) for w in tokens[:context_len]] for tokens in context_tokens]
+    qn_ids = [[word2id.get(w, UNK_ID) for w in tokens[:question_len]] for tokens in qn_tokens]
 
-    # Get next example
-    qn_uuid, context_tokens, qn_tokens = readnext(qn_uuid_data), readnext(context_token_data), readnext(qn_token_data)
+    # Pad context_ids and qn_ids
+    qn_ids = padded(qn_ids, 0 if pad_to_batch_max else question_len) # pad questions to length question_len (or the longest question)
+    context_ids = padded(context_ids, 0 if pad_to_batch_max else context_len) # pad contexts to length context_len (or the longest context)
 
-    while qn_uuid and context_tokens and qn_tokens:
+    # Make qn_ids into a np array and create qn_mask
+    qn_ids = np.array(qn_ids)
+    qn_mask = (qn_ids != PAD_ID).astype(np.int32)
 
-        # Convert context_tokens and qn_tokens to context_ids and qn_ids
-        context_ids = [word2id.get(w, UNK_ID) for w in context_tokens]
-        qn_ids = [word2id.get(w, UNK_ID) for w in qn_tokens]
+    # Make context_ids into a np array and create context_mask
+    context_ids = np.array(context_ids)
+    context_mask = (context_ids != PAD_ID).astype(np.int32)
 
-        # Truncate context_ids and qn_ids
-        # Note: truncating context_ids may truncate the correct answer, meaning that it's impossible for your model to get the correct answer on this example!
-        if len(qn_ids) > question_len:
-            qn_ids = qn_ids[:question_len]
-        if len(context_ids) > context_len:
-            context_ids = context_ids[:context_len]
+    # Make into a Batch object
+    batch = Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens=None, ans_span=None, ans_tokens=None, uuids=uuids)
+    if dedup:
+        dedup_contexts(batch)
 
-        # Add to list of examples
-        examples.append((qn_uuid, context_tokens, context_ids, qn_ids))
-
-        # Stop if you've got a batch
-        if len(examples) == batch_size:
-            break
-
-        # Get next example
-        qn_uuid, context_tokens, qn_tokens = readnext(qn_uuid_data), readnext(context_token_data), readnext(qn_token_data)
-
-    # Make into batches
-    for batch_start in xrange(0, len(examples), batch_size):
-        uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch = zip(*examples[batch_start:batch_start + batch_size])
-
-        batches.append((uuids_batch, context_tokens_batch, context_ids_batch, qn_ids_batch))
-
-    return
+    return batch
 
 
 
-def get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len):
+def get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len, dedup=False, sort_by_length=False):
     """
-    This is similar to get_batch_generator in data_batcher.py, but with some
-    differences (see explanation in refill_batches).
+    This is similar to get_batch_generator in data_batcher.py, but:
+      (1) instead of reading from (preprocessed) datafiles, it reads from the provided lists
+      (2) it only puts the context and question information in the batches (not the answer information)
+      (3) it also gets UUID information and puts it in the batches
+    The examples are batched in order (unless sort_by_length), and the provided lists aren't modified.
 
     Inputs:
       word2id: dictionary mapping word (string) to word id (int)
@@ -106,42 +96,73 @@ def get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data
       context_token_data, qn_token_data: list of lists of strings (no UNKs, no padding)
       batch_size: int. size of batches to make
       context_len, question_len: ints. max sizes of context and question. Anything longer is truncated.
+      dedup: If True, deduplicate the contexts in each batch (see data_batcher.dedup_contexts).
+        The questions about each context are consecutive in the SQuAD JSON, so batches contain few distinct contexts.
+      sort_by_length: If True, batch the examples in order of (truncated) context length, then question length,
+        and pad each batch only to its own max length. This minimizes padding,
+        but the batches are out of order, so use the uuids to match up the results.
+        With dedup, the questions about each context are also kept together.
 
     Yields:
       Batch objects, but they only contain context and question information (no answer information)
     """
-    batches = []
-
-    while True:
-        if len(batches) == 0:
-            refill_batches(batches, word2id, qn_uuid_data, context_token_data, qn_token_data, batch_size, context_len, question_len)
-        if len(batches) == 0:
-            break
-
-        # Get next batch. These are all lists length batch_size
-        (uuids, context_tokens, context_ids, qn_ids) = batches.pop(0)
+    if sort_by_length and dedup:
+        # Sort by context length, then context, then question length
+        order = sorted(xrange(len(qn_uuid_data)), key=lambda idx: (min(len(context_token_data[idx]), context_len), context_token_data[idx], min(len(qn_token_data[idx]), question_len)))
+    elif sort_by_length:
+        # Sort by context length, then question length
+        order = sorted(xrange(len(qn_uuid_data)), key=lambda idx: (min(len(context_token_data[idx]), context_len), min(len(qn_token_data[idx]), question_len)))
+
+    for batch_start in xrange(0, len(qn_uuid_data), batch_size):
+        batch_end = batch_start + batch_size
+
+        # These are all lists length batch_size (except the last one, which might be shorter)
+        if sort_by_length:
+            batch_idxs = order[batch_start:batch_end]
+            uuids = [qn_uuid_data[idx] for idx in batch_idxs]
+            context_tokens = [context_token_data[idx] for idx in batch_idxs]
+            qn_tokens = [qn_token_data[idx] for idx in batch_idxs]
+        else:
+            uuids = qn_uuid_data[batch_start:batch_end]
+            context_tokens = context_token_data[batch_start:batch_end]
+            qn_tokens = qn_token_data[batch_start:batch_end]
+
+        yield make_batch(word2id, uuids, context_tokens, qn_tokens, context_len, question_len, pad_to_batch_max=sort_by_length, dedup=dedup)
+
+
+def tokenize_context(context):
+    """
+    Tokenizes a context (unicode string) the same way as squad_preprocess.py.
+    Returns a list of strings (lowercase).
+    """
+    # The following replacements are suggested in the paper
+    # BidAF (Seo et al., 2016)
+    context = context.replace("''", '" ')
+    context = context.replace("``", '" ')
 
-        # Pad context_ids and qn_ids
-        qn_ids = padded(qn_ids, question_len) # pad questions to length question_len
-        context_ids = padded(context_ids, context_len) # pad contexts to length context_len
+    return tokenize(context)
 
-        # Make qn_ids into a np array and create qn_mask
-        qn_ids = np.array(qn_ids)
-        qn_mask = (qn_ids != PAD_ID).astype(np.int32)
 
-        # Make context_ids into a np array and create context_mask
-        context_ids = np.array(context_ids)
-        context_mask = (context_ids != PAD_ID).astype(np.int32)
+def get_answer_text(context_tokens, pred_start, pred_end, detokenizer):
+    """
+    Returns the predicted answer (a detokenized string) for a predicted span.
 
-        # Make into a Batch object
-        batch = Batch(context_ids, context_mask, context_tokens, qn_ids, qn_mask, qn_tokens=None, ans_span=None, ans_tokens=None, uuids=uuids)
+    Inputs:
+      context_tokens: list of strings. The original context tokens (no UNKs or padding)
+      pred_start, pred_end: ints. The predicted span
+      detokenizer: MosesDetokenizer
+    """
+    # Check the predicted span is in range
+    assert pred_start in range(len(context_tokens))
+    assert pred_end in range(len(context_tokens))
 
-        yield batch
+    # Predicted answer tokens
+    pred_ans_tokens = context_tokens[pred_start : pred_end +1] # list of strings
 
-    return
+    return detokenizer.detokenize(pred_ans_tokens, return_str=True)
 
 
-def preprocess_dataset(dataset):
+def preprocess_dataset(dataset, pool=None):
     """
     Note: this is similar to squad_preprocess.preprocess_and_write, but:
       (1) We only extract the context and question information from the JSON file.
@@ -152,6 +173,8 @@ def preprocess_dataset(dataset):
 
     Input:
       dataset: data read from SQuAD JSON file
+      pool: optional multiprocessing.Pool to tokenize the paragraphs in.
+        The results are the same (and in the same order) as without one.
 
     Returns:
       qn_uuid_data, context_token_data, qn_token_data: lists of uuids, tokenized context and tokenized questions
@@ -160,43 +183,111 @@ def preprocess_dataset(dataset):
     context_token_data = []
     qn_token_data = []
 
-    for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing data"):
-        article_paragraphs = dataset['data'][articles_id]['paragraphs']
-        for pid in range(len(article_paragraphs)):
+    # Each paragraph is (context, [(question_uuid, question), ...]), as in iter_paragraphs
+    paragraphs = [(paragraph['context'], [(qn['id'], qn['question']) for qn in paragraph['qas']])
+                  for article in dataset['data'] for paragraph in article['paragraphs']]
+
+    if pool is None:
+        tokenized = itertools.imap(tokenize_paragraph, paragraphs)
+    else:
+        tokenized = pool.imap(tokenize_paragraph, paragraphs, chunksize=16) # imap returns the results in order
 
-            context = unicode(article_paragraphs[pid]['context']) # string
+    for context_tokens, qns in tqdm(tokenized, total=len(paragraphs), desc="Preprocessing data"):
 
-            # The following replacements are suggested in the paper
-            # BidAF (Seo et al., 2016)
-            context = context.replace("''", '" ')
-            context = context.replace("``", '" ')
+        # for each question
+        for question_uuid, question_tokens in qns:
 
-            context_tokens = tokenize(context) # list of strings (lowercase)
-            context = context.lower()
+            # Append to data lists
+            qn_uuid_data.append(question_uuid)
+            context_token_data.append(context_tokens)
+            qn_token_data.append(question_tokens)
+
+    return qn_uuid_data, context_token_data, qn_token_data
 
-            qas = article_paragraphs[pid]['qas'] # list of questions
 
-            # for each question
-            for qn in qas:
+def file_hash(filename):
+    """Returns the sha1 hex digest of a file's contents"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
 
-                # read the question text and tokenize
-                question = unicode(qn['question']) # string
-                question_tokens = tokenize(question) # list of strings
 
-                # also get the question_uuid
-                question_uuid = qn['id']
+def get_tokenization_cache_path(data_filename, cache_dir):
+    """
+    Returns the path of the cached tokenization of data_filename in cache_dir.
+    The name depends on the file's contents and TOKENIZER_VERSION, so a changed file or tokenizer gets a new entry.
+    """
+    key = hashlib.sha1(file_hash(data_filename) + TOKENIZER_VERSION).hexdigest()
+    return os.path.join(cache_dir, key + ".npz")
 
-                # Append to data lists
-                qn_uuid_data.append(question_uuid)
-                context_token_data.append(context_tokens)
-                qn_token_data.append(question_tokens)
 
+def write_tokenization_cache(cache_path, qn_uuid_data, context_token_data, qn_token_data):
+    """
+    Writes the output of preprocess_dataset to cache_path, compactly:
+    each distinct token and context is stored once, and the contexts and questions as arrays of token numbers.
+    """
+    vocab = {} # maps token to token number
+    context_numbers = {} # maps id() of context token list to context number. preprocess_dataset shares one list per paragraph
+    context_ids, context_offsets, context_index = [], [0], []
+    qn_ids, qn_offsets = [], [0]
+
+    for context_tokens, qn_tokens in zip(context_token_data, qn_token_data):
+        if id(context_tokens) not in context_numbers:
+            context_numbers[id(context_tokens)] = len(context_numbers)
+            context_ids.extend(vocab.setdefault(token, len(vocab)) for token in context_tokens)
+            context_offsets.append(len(context_ids))
+        context_index.append(context_numbers[id(context_tokens)])
+
+        qn_ids.extend(vocab.setdefault(token, len(vocab)) for token in qn_tokens)
+        qn_offsets.append(len(qn_ids))
+
+    # The tokens and uuids are stored as newline-separated utf-8 (tokens never contain whitespace)
+    words = sorted(vocab, key=vocab.get)
+    arrays = {
+        "vocab": np.frombuffer(u"\n".join(words).encode('utf-8'), dtype=np.uint8),
+        "uuids": np.frombuffer(u"\n".join(qn_uuid_data).encode('utf-8'), dtype=np.uint8),
+        "context_ids": np.array(context_ids, dtype=np.int32),
+        "context_offsets": np.array(context_offsets, dtype=np.int64),
+        "context_index": np.array(context_index, dtype=np.int32),
+        "qn_ids": np.array(qn_ids, dtype=np.int32),
+        "qn_offsets": np.array(qn_offsets, dtype=np.int64),
+    }
+
+    # Write to a temporary file, then rename, so that a partly written cache is never read
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_path = "%s.tmp%i" % (cache_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.rename(tmp_path, cache_path)
+
+
+def read_tokenization_cache(cache_path):
+    """Reads a cache written by write_tokenization_cache. Returns qn_uuid_data, context_token_data, qn_token_data"""
+    arrays = np.load(cache_path)
+    vocab = arrays["vocab"].tostring().decode('utf-8').split(u"\n")
+    context_ids, context_offsets = arrays["context_ids"].tolist(), arrays["context_offsets"].tolist()
+    qn_ids, qn_offsets = arrays["qn_ids"].tolist(), arrays["qn_offsets"].tolist()
+
+    # As in preprocess_dataset, the questions about a context share one list of context tokens
+    contexts = [[vocab[token] for token in context_ids[start:end]] for start, end in zip(context_offsets[:-1], context_offsets[1:])]
+
+    qn_uuid_data = arrays["uuids"].tostring().decode('utf-8').split(u"\n")
+    context_token_data = [contexts[context_num] for context_num in arrays["context_index"].tolist()]
+    qn_token_data = [[vocab[token] for token in qn_ids[start:end]] for start, end in zip(qn_offsets[:-1], qn_offsets[1:])]
     return qn_uuid_data, context_token_data, qn_token_data
 
 
-def get_json_data(data_filename):
+def get_json_data(data_filename, pool=None, cache_dir=""):
     """
     Read the contexts and questions from a .json file (like dev-v1.1.json)
+    If pool (a multiprocessing.Pool) is given, tokenize in its worker processes.
+
+    If cache_dir is given, the tokenized data is cached there (see write_tokenization_cache),
+    keyed by the contents of the file and TOKENIZER_VERSION, so the next run with the same file skips tokenization.
 
     Returns:
       qn_uuid_data: list (length equal to dev set size) of unicode strings like '56be4db0acb8001400a502ec'
@@ -206,19 +297,32 @@ def get_json_data(data_filename):
     if not os.path.exists(data_filename):
         raise Exception("JSON input file does not exist: %s" % data_filename)
 
+    # Use the cached tokenization, if there is one
+    if cache_dir:
+        cache_path = get_tokenization_cache_path(data_filename, cache_dir)
+        if os.path.exists(cache_path):
+            print "Reading tokenized data for %s from %s..." % (data_filename, cache_path)
+            qn_uuid_data, context_token_data, qn_token_data = read_tokenization_cache(cache_path)
+            print "Finished reading. Got %i examples from %s" % (len(qn_uuid_data), cache_path)
+            return qn_uuid_data, context_token_data, qn_token_data
+
     # Read the json file
     print "Reading data from %s..." % data_filename
     data = data_from_json(data_filename)
 
     # Get the tokenized contexts and questions, and unique question identifiers
     print "Preprocessing data from %s..." % data_filename
-    qn_uuid_data, context_token_data, qn_token_data = preprocess_dataset(data)
+    qn_uuid_data, context_token_data, qn_token_data = preprocess_dataset(data, pool)
 
     data_size = len(qn_uuid_data)
     assert len(context_token_data) == data_size
     assert len(qn_token_data) == data_size
     print "Finished preprocessing. Got %i examples from %s" % (data_size, data_filename)
 
+    if cache_dir:
+        print "Caching tokenized data in %s" % cache_path
+        write_tokenization_cache(cache_path, qn_uuid_data, context_token_data, qn_token_data)
+
     return qn_uuid_data, context_token_data, qn_token_data
 
 
@@ -228,6 +332,9 @@ def generate_answers(session, model, word2id, qn_uuid_data, context_token_data,
     use the model to generate an answer for each pair, and return a dictionary mapping
     each unique ID to the generated answer.
 
+    If model.FLAGS.bucket_by_length, the examples are run in order of length,
+    with each batch padded only to its own max length (see get_batch_generator).
+
     Inputs:
       session: TensorFlow session
       model: QAModel
@@ -241,14 +348,17 @@ def generate_answers(session, model, word2id, qn_uuid_data, context_token_data,
     data_size = len(qn_uuid_data)
     num_batches = ((data_size-1) / model.FLAGS.batch_size) + 1
     batch_num = 0
+    num_padded, num_real = 0, 0 # number of (padded) context positions processed, and how many of them are real
     detokenizer = MosesDetokenizer()
 
     print "Generating answers..."
 
-    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len):
+    for batch in get_batch_generator(word2id, qn_uuid_data, context_token_data, qn_token_data, model.FLAGS.batch_size, model.FLAGS.context_len, model.FLAGS.question_len, dedup=model.FLAGS.dedup_contexts, sort_by_length=model.FLAGS.bucket_by_length):
 
         # Get the predicted spans
         pred_start_batch, pred_end_batch = model.get_start_end_pos(session, batch)
+        num_padded += batch.context_mask.size
+        num_real += batch.context_mask.sum()
 
         # Convert pred_start_batch and pred_end_batch to lists length batch_size
         pred_start_batch = pred_start_batch.tolist()
@@ -260,22 +370,192 @@ def generate_answers(session, model, word2id, qn_uuid_data, context_token_data,
             # Original context tokens (no UNKs or padding) for this example
             context_tokens = batch.context_tokens[ex_idx] # list of strings
 
-            # Check the predicted span is in range
-            assert pred_start in range(len(context_tokens))
-            assert pred_end in range(len(context_tokens))
-
-            # Predicted answer tokens
-            pred_ans_tokens = context_tokens[pred_start : pred_end +1] # list of strings
-
             # Detokenize and add to dict
+            # (by uuid, because the batches aren't in order if they're sorted by length)
             uuid = batch.uuids[ex_idx]
-            uuid2ans[uuid] = detokenizer.detokenize(pred_ans_tokens, return_str=True)
+            uuid2ans[uuid] = get_answer_text(context_tokens, pred_start, pred_end, detokenizer)
 
         batch_num += 1
 
         if batch_num % 10 == 0:
             print "Generated answers for %i/%i batches = %.2f%%" % (batch_num, num_batches, batch_num*100.0/num_batches)
 
-    print "Finished generating answers for dataset."
+    print "Finished generating answers for dataset. %.1f%% of context positions were padding" % (100. * (num_padded - num_real) / max(num_padded, 1))
 
     return uuid2ans
+
+
+def iter_json_array(f, key, chunk_size=2**20):
+    """
+    Incrementally yields the elements of the top-level array f[key] of a JSON file,
+    e.g. the articles in a SQuAD JSON file (key "data"), without reading the whole file into memory.
+
+    Inputs:
+      f: file object open for reading unicode text
+      key: string. The key of the array
+      chunk_size: int. How many characters to read at a time
+    """
+    decoder = json.JSONDecoder()
+    start_re = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    buf, eof = u"", False
+
+    # Find the start of the array
+    while True:
+        match = start_re.search(buf)
+        if match:
+            buf = buf[match.end():]
+            break
+        if eof:
+            raise Exception("Couldn't find the %s array in the JSON file" % key)
+        chunk = f.read(chunk_size)
+        eof = not chunk
+        buf += chunk
+
+    # Decode one element at a time, reading more whenever the buffer holds only part of an element
+    while True:
+        buf = buf.lstrip(u" \t\r\n,")
+        if buf.startswith(u"]"):
+            return
+        try:
+            if not buf:
+                raise ValueError("Empty buffer")
+            element, end = decoder.raw_decode(buf)
+        except ValueError:
+            if eof:
+                raise Exception("The JSON file ended in the middle of the %s array" % key)
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf += chunk
+            continue
+        yield element
+        buf = buf[end:]
+
+
+def iter_paragraphs(data_filename):
+    """
+    Incrementally reads the paragraphs (contexts and their questions) from a SQuAD JSON file or a JSONL file.
+
+    In a JSONL file, each line is either a SQuAD article (with "paragraphs"),
+    or a single question {"id": ..., "context": ..., "question": ...}.
+
+    Yields:
+      (context, [(question_uuid, question), ...]) pairs. All strings are unicode.
+    """
+    with io.open(data_filename, 'r', encoding='utf-8') as f:
+        if data_filename.endswith(".jsonl"):
+            articles = (json.loads(line) for line in f if line.strip())
+        else:
+            articles = iter_json_array(f, "data")
+
+        for article in articles:
+            if "paragraphs" not in article:
+                yield article['context'], [(article['id'], article['question'])]
+                continue
+            for paragraph in article['paragraphs']:
+                yield paragraph['context'], [(qn['id'], qn['question']) for qn in paragraph['qas']]
+
+
+def tokenize_paragraph(paragraph):
+    """
+    Tokenizes a paragraph from iter_paragraphs. This runs in the tokenizer worker processes.
+
+    Returns:
+      (context_tokens, [(question_uuid, question_tokens), ...])
+    """
+    context, qns = paragraph
+    return tokenize_context(unicode(context)), [(uuid, tokenize(unicode(question))) for uuid, question in qns]
+
+
+def iter_tokenized_paragraphs(paragraphs, pool, window_size=256):
+    """
+    Tokenizes paragraphs in a pool of worker processes, yielding them in order.
+
+    Only two windows of window_size paragraphs are in flight at once
+    (one being tokenized while the previous one is consumed), so memory use doesn't grow with the input size.
+
+    Inputs:
+      paragraphs: iterator, e.g. from iter_paragraphs
+      pool: multiprocessing.Pool
+      window_size: int. Number of paragraphs to hand to the pool at a time
+    """
+    window = list(itertools.islice(paragraphs, window_size))
+    pending = pool.map_async(tokenize_paragraph, window) if window else None
+    while pending is not None:
+        tokenized = pending.get()
+        window = list(itertools.islice(paragraphs, window_size))
+        pending = pool.map_async(tokenize_paragraph, window) if window else None
+        for paragraph in tokenized:
+            yield paragraph
+
+
+def stream_answers(session, model, word2id, data_filename, out_filename, pool):
+    """
+    Like generate_answers, but reads the data incrementally (see iter_paragraphs),
+    tokenizes it in a pool of worker processes, and writes each batch of predictions to the output file as soon as it's made.
+    Memory use stays flat however big the input is.
+
+    If out_filename ends with .jsonl, writes one {"id": ..., "answer": ...} object per line.
+    Otherwise writes a JSON object mapping uuid to answer, as in official_eval mode.
+
+    Inputs:
+      session: TensorFlow session
+      model: QAModel
+      word2id: dictionary mapping word (string) to word id (int)
+      data_filename: path to SQuAD JSON or JSONL input file
+      out_filename: path to write predictions to
+      pool: multiprocessing.Pool to tokenize in
+
+    Returns:
+      num_answers: int. Number of predictions written
+    """
+    if not os.path.exists(data_filename):
+        raise Exception("JSON input file does not exist: %s" % data_filename)
+
+    flags = model.FLAGS
+    jsonl = out_filename.endswith(".jsonl")
+    detokenizer = MosesDetokenizer()
+    num_answers, tic = 0, time.time()
+    uuids, context_tokens, qn_tokens = [], [], [] # examples waiting to be batched
+
+    print "Streaming answers for %s to %s..." % (data_filename, out_filename)
+
+    with io.open(out_filename, 'w', encoding='utf-8') as out_file:
+        if not jsonl:
+            out_file.write(u"{")
+
+        def answer_batch(batch_size):
+            """Answers the first batch_size waiting examples, and writes the answers"""
+            batch = make_batch(word2id, uuids[:batch_size], context_tokens[:batch_size], qn_tokens[:batch_size], flags.context_len, flags.question_len, dedup=flags.dedup_contexts)
+            pred_start_batch, pred_end_batch = model.get_start_end_pos(session, batch)
+
+            for ex_idx, (pred_start, pred_end) in enumerate(zip(pred_start_batch.tolist(), pred_end_batch.tolist())):
+                answer = get_answer_text(batch.context_tokens[ex_idx], pred_start, pred_end, detokenizer)
+                if jsonl:
+                    out_file.write(unicode(json.dumps({"id": batch.uuids[ex_idx], "answer": answer}, ensure_ascii=False)) + u"\n")
+                else:
+                    separator = u", " if num_answers + ex_idx else u""
+                    out_file.write(separator + unicode(json.dumps(batch.uuids[ex_idx], ensure_ascii=False)) + u": " + unicode(json.dumps(answer, ensure_ascii=False)))
+            out_file.flush()
+
+            del uuids[:batch_size], context_tokens[:batch_size], qn_tokens[:batch_size]
+            return len(batch.uuids)
+
+        for paragraph_context_tokens, qns in iter_tokenized_paragraphs(iter_paragraphs(data_filename), pool):
+            for uuid, question_tokens in qns:
+                uuids.append(uuid)
+                context_tokens.append(paragraph_context_tokens)
+                qn_tokens.append(question_tokens)
+
+            while len(uuids) >= flags.batch_size:
+                num_answers += answer_batch(flags.batch_size)
+                if num_answers % (flags.batch_size * 10) == 0:
+                    print "Generated %i answers (%.1f answers/sec)" % (num_answers, num_answers / (time.time() - tic))
+
+        if uuids:
+            num_answers += answer_batch(len(uuids))
+
+        if not jsonl:
+            out_file.write(u"}")
+
+    print "Finished streaming %i answers in %.2f seconds" % (num_answers, time.time() - tic)
+    return num_answers
@@ -0,0 +1,260 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains code to compile the tokenized {train/dev}.{context/question/span}
+files into packed arrays of word ids, and to make batches from those arrays.
+
+This is an alternative to data_batcher.get_batch_generator for training:
+the text files are only read, split and mapped to word ids once (when compiling),
+after which each epoch just slices memory-mapped numpy arrays.
+
+A packed dataset is a directory containing:
+  context_ids.npy: int32, the word ids of every distinct context, concatenated
+  context_offsets.npy: int64, shape (num_contexts+1). Context i is context_ids[context_offsets[i]:context_offsets[i+1]]
+  context_index.npy: int32, shape (num_examples). The context number of each example
+  qn_ids.npy, qn_offsets.npy: the same for the questions (one per example)
+  ans_span.npy: int32, shape (num_examples, 2)
+  meta.json: what the dataset was compiled from, to know when it needs recompiling
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import os
+import json
+import time
+import random
+import hashlib
+
+import numpy as np
+from six.moves import xrange, zip
+
+from vocab import PAD_ID
+from data_batcher import Batch, sentence_to_token_ids, intstr_to_intlist, token_budget_batch_ranges, dedup_contexts
+
+
+PACKED_DATA_VERSION = 1
+ARRAY_NAMES = ["context_ids", "context_offsets", "context_index", "qn_ids", "qn_offsets", "ans_span"]
+
+
+class PackedData(object):
+    """A packed dataset, loaded with load_packed_data. The arrays are memory-mapped (read-only)."""
+
+    def __init__(self, context_ids, context_offsets, context_index, qn_ids, qn_offsets, ans_span):
+        self.context_ids = context_ids
+        self.context_offsets = context_offsets
+        self.context_index = context_index
+        self.qn_ids = qn_ids
+        self.qn_offsets = qn_offsets
+        self.ans_span = ans_span
+
+        # Start and length of each example's context and question, all shape (num_examples)
+        self.context_starts = context_offsets[:-1][context_index]
+        self.context_lens = np.diff(context_offsets)[context_index]
+        self.qn_starts = qn_offsets[:-1]
+        self.qn_lens = np.diff(qn_offsets)
+
+        self.num_examples = len(context_index)
+
+
+def vocab_hash(word2id):
+    """Returns a hash of the word -> word id mapping, so we know if a packed dataset used a different vocab"""
+    words = sorted(word2id, key=word2id.get)
+    return hashlib.md5("\n".join(words)).hexdigest()
+
+
+def source_info(paths):
+    """Returns the size and modification time of each source file"""
+    return dict((path, [os.path.getsize(path), os.path.getmtime(path)]) for path in paths)
+
+
+def compile_packed_data(word2id, context_path, qn_path, ans_path, out_dir):
+    """
+    Reads the tokenized {train/dev}.{context/question/span} files and writes them as a packed dataset.
+    As in data_batcher.refill_batches, examples with an ill-formed gold span are skipped.
+
+    Inputs:
+      word2id: dictionary mapping word (string) to word id (int)
+      context_path, qn_path, ans_path: paths to {train/dev}.{context/question/span} data files
+      out_dir: directory to write the packed dataset to
+    """
+    print "Compiling packed dataset from %s to %s..." % (context_path, out_dir)
+    tic = time.time()
+
+    context_ids, context_offsets, context_index = [], [0], []
+    qn_ids, qn_offsets = [], [0]
+    ans_span = []
+    context_numbers = {} # maps context line to context number, so that each distinct context is stored once
+    num_illformed = 0
+
+    with open(context_path) as context_file, open(qn_path) as qn_file, open(ans_path) as ans_file:
+        for context_line, qn_line, ans_line in zip(context_file, qn_file, ans_file):
+            span = intstr_to_intlist(ans_line)
+            assert len(span) == 2
+            if span[1] < span[0]:
+                num_illformed += 1
+                continue
+
+            if context_line not in context_numbers:
+                context_numbers[context_line] = len(context_numbers)
+                context_ids.extend(sentence_to_token_ids(context_line, word2id)[1])
+                context_offsets.append(len(context_ids))
+            context_index.append(context_numbers[context_line])
+
+            qn_ids.extend(sentence_to_token_ids(qn_line, word2id)[1])
+            qn_offsets.append(len(qn_ids))
+
+            ans_span.append(span)
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    arrays = {
+        "context_ids": np.array(context_ids, dtype=np.int32),
+        "context_offsets": np.array(context_offsets, dtype=np.int64),
+        "context_index": np.array(context_index, dtype=np.int32),
+        "qn_ids": np.array(qn_ids, dtype=np.int32),
+        "qn_offsets": np.array(qn_offsets, dtype=np.int64),
+        "ans_span": np.array(ans_span, dtype=np.int32).reshape(-1, 2),
+    }
+    for name in ARRAY_NAMES:
+        np.save(os.path.join(out_dir, name + ".npy"), arrays[name])
+
+    # Write meta.json last, so that an interrupted compile is never mistaken for a complete one
+    meta = {
+        "version": PACKED_DATA_VERSION,
+        "num_examples": len(context_index),
+        "vocab_hash": vocab_hash(word2id),
+        "sources": source_info([context_path, qn_path, ans_path]),
+    }
+    with open(os.path.join(out_dir, "meta.json"), 'w') as f:
+        json.dump(meta, f)
+
+    toc = time.time()
+    print "Compiled %i examples (%i distinct contexts, %i ill-formed spans skipped) in %.2f seconds" % (len(context_index), len(context_numbers), num_illformed, toc-tic)
+
+
+def is_packed_data_fresh(word2id, context_path, qn_path, ans_path, out_dir):
+    """Returns True if out_dir holds a packed dataset compiled from the given files with the given vocab"""
+    meta_path = os.path.join(out_dir, "meta.json")
+    if not os.path.exists(meta_path):
+        return False
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return (meta["version"] == PACKED_DATA_VERSION and
+            meta["vocab_hash"] == vocab_hash(word2id) and
+            meta["sources"] == source_info([context_path, qn_path, ans_path]))
+
+
+def load_packed_data(out_dir):
+    """Loads (memory-maps) a packed dataset written by compile_packed_data"""
+    arrays = [np.load(os.path.join(out_dir, name + ".npy"), mmap_mode='r') for name in ARRAY_NAMES]
+    return PackedData(*arrays)
+
+
+def get_packed_data(word2id, context_path, qn_path, ans_path, out_dir):
+    """Loads the packed dataset in out_dir, compiling it first if it's missing or out of date"""
+    if not is_packed_data_fresh(word2id, context_path, qn_path, ans_path, out_dir):
+        compile_packed_data(word2id, context_path, qn_path, ans_path, out_dir)
+    return load_packed_data(out_dir)
+
+
+def gather_padded(flat_ids, starts, lens, pad_len):
+    """
+    Slices variable-length sequences out of flat_ids, padding or truncating them to pad_len.
+
+    Inputs:
+      flat_ids: numpy array of concatenated sequences
+      starts, lens: numpy arrays shape (batch_size). Where each sequence starts in flat_ids, and its length
+        (already truncated if necessary)
+      pad_len: int. Length to pad to
+
+    Returns:
+      ids, mask: numpy arrays shape (batch_size, pad_len)
+    """
+    positions = np.arange(pad_len)[np.newaxis, :]
+    mask = positions < lens[:, np.newaxis]
+    flat_idx = np.where(mask, starts[:, np.newaxis] + positions, 0)
+    ids = np.where(mask, flat_ids[flat_idx], PAD_ID).astype(np.int32)
+    return ids, mask.astype(np.int32)
+
+
+def make_packed_batch(packed, example_idxs, context_len, question_len, bucket_by_length, dedup=False):
+    """Makes a Batch (without any token information) for the given examples of a PackedData"""
+    context_lens = np.minimum(packed.context_lens[example_idxs], context_len)
+    qn_lens = np.minimum(packed.qn_lens[example_idxs], question_len)
+
+    context_pad_len = context_lens.max() if bucket_by_length else context_len
+    qn_pad_len = qn_lens.max() if bucket_by_length else question_len
+
+    context_ids, context_mask = gather_padded(packed.context_ids, packed.context_starts[example_idxs], context_lens, context_pad_len)
+    qn_ids, qn_mask = gather_padded(packed.qn_ids, packed.qn_starts[example_idxs], qn_lens, qn_pad_len)
+    ans_span = np.array(packed.ans_span[example_idxs])
+
+    batch = Batch(context_ids, context_mask, None, qn_ids, qn_mask, None, ans_span, None)
+    if dedup:
+        # The context numbers tell us which contexts are the same, without comparing the ids
+        dedup_contexts(batch, packed.context_index[example_idxs])
+    return batch
+
+
+def get_packed_batch_generator(packed, batch_size, context_len, question_len, discard_long, bucket_by_length=False, max_batch_tokens=0, shuffle_rng=None, dedup=False):
+    """
+    Like data_batcher.get_batch_generator, but makes batches from a PackedData.
+    The batches don't contain any token information (just ids, masks and spans), so they're only suitable for training.
+
+    As in data_batcher.get_batch_generator, examples are taken in windows of 160 batches,
+    sorted by length within each window, and the batches within each window are shuffled.
+
+    Inputs:
+      packed: PackedData
+      shuffle_rng: If given, a np.random.RandomState used to shuffle the whole dataset
+        (a random permutation of the examples, before splitting into windows)
+        and the batches within each window. This makes the order reproducible given the seed.
+        If None, examples are taken in file order and batches are shuffled with the random module.
+      Others: see data_batcher.get_batch_generator
+    """
+    example_idxs = np.arange(packed.num_examples)
+    if discard_long:
+        keep = (packed.context_lens <= context_len) & (packed.qn_lens <= question_len)
+        example_idxs = example_idxs[keep]
+    if shuffle_rng is not None:
+        example_idxs = shuffle_rng.permutation(example_idxs)
+
+    window_size = batch_size * 160
+    for window_start in xrange(0, len(example_idxs), window_size):
+        window = example_idxs[window_start:window_start+window_size]
+        context_lens = np.minimum(packed.context_lens[window], context_len)
+        qn_lens = np.minimum(packed.qn_lens[window], question_len)
+
+        # Sort as in data_batcher.refill_batches (np.lexsort sorts by the last key first, and is stable)
+        if bucket_by_length and dedup:
+            window = window[np.lexsort((qn_lens, packed.context_index[window], context_lens))]
+        elif bucket_by_length:
+            window = window[np.lexsort((qn_lens, context_lens))]
+        else:
+            window = window[np.argsort(qn_lens, kind='mergesort')]
+
+        if max_batch_tokens:
+            padded_context_lens = np.minimum(packed.context_lens[window], context_len) if bucket_by_length else [context_len] * len(window)
+            batch_ranges = token_budget_batch_ranges(padded_context_lens, max_batch_tokens)
+        else:
+            batch_ranges = [(batch_start, batch_start+batch_size) for batch_start in xrange(0, len(window), batch_size)]
+
+        if shuffle_rng is not None:
+            shuffle_rng.shuffle(batch_ranges)
+        else:
+            random.shuffle(batch_ranges)
+        for batch_start, batch_end in batch_ranges:
+            yield make_packed_batch(packed, window[batch_start:batch_end], context_len, question_len, bucket_by_length, dedup)
@@ -19,6 +19,7 @@ import sys
 import random
 import argparse
 import json
+import multiprocessing
 import nltk
 import numpy as np
 from tqdm import tqdm
@@ -35,6 +36,7 @@ SQUAD_BASE_URL = "https://rajpurkar.github.io/SQuAD-explorer/dataset/"
 def setup_args():
     parser = argparse.ArgumentParser()
     parser.add_argument("--data_dir", required=True)
+    parser.add_argument("--num_workers", type=int, default=0, help="Number of worker processes to tokenize with. 0 means one per CPU, 1 means no worker processes")
     return parser.parse_args()
 
 
@@ -117,118 +119,171 @@ def get_char_word_loc_mapping(context, context_tokens):
     Return a mapping that maps from character locations to the corresponding token locations.
     If we're unable to complete the mapping e.g. because of special characters, we return None.
 
+    The non-space characters of the context (spaces being ' ' and '\n') must be exactly the tokens, in order.
+    Each token's characters are found by offset into the non-space characters, without building any strings per character.
+
     Inputs:
       context: string (unicode)
       context_tokens: list of strings (unicode)
 
     Returns:
-      mapping: dictionary from ints (character locations) to (token, token_idx) pairs
-        Only ints corresponding to non-space character locations are in the keys
+      mapping: numpy array of ints, shape (len(context)). Maps character location to token location,
+        or -1 for character locations that aren't part of a token (i.e. spaces)
         e.g. if context = "hello world" and context_tokens = ["hello", "world"] then
-        0,1,2,3,4 are mapped to ("hello", 0) and 6,7,8,9,10 are mapped to ("world", 1)
+        mapping is [0, 0, 0, 0, 0, -1, 1, 1, 1, 1, 1]
     """
-    acc = '' # accumulator
-    current_token_idx = 0 # current word loc
-    mapping = dict()
-
-    for char_idx, char in enumerate(context): # step through original characters
-        if char != u' ' and char != u'\n': # if it's not a space:
-            acc += char # add to accumulator
-            context_token = unicode(context_tokens[current_token_idx]) # current word token
-            if acc == context_token: # if the accumulator now matches the current word token
-                syn_start = char_idx - len(acc) + 1 # char loc of the start of this word
-                for char_loc in range(syn_start, char_idx+1):
-                    mapping[char_loc] = (acc, current_token_idx) # add to mapping
-                acc = '' # reset accumulator
-                current_token_idx += 1
-
-    if current_token_idx != len(context_tokens):
+    context_tokens = [unicode(token) for token in context_tokens]
+    token_lens = np.array([len(token) for token in context_tokens], dtype=np.int64)
+
+    # The tokens, concatenated, must be the non-space characters of the context (and no token can be empty)
+    if u"".join(context_tokens) != context.replace(u' ', u'').replace(u'\n', u'') or (token_lens == 0).any():
         return None
+
+    # The context's code units, indexed like the unicode string (i.e. UTF-16 code units on a "narrow build" of Python 2)
+    if sys.maxunicode > 0xFFFF:
+        codes = np.frombuffer(context.encode('utf-32-le'), dtype=np.uint32)
     else:
-        return mapping
+        codes = np.frombuffer(context.encode('utf-16-le'), dtype=np.uint16)
+    nonspace_locs = np.flatnonzero((codes != ord(u' ')) & (codes != ord(u'\n'))) # char loc of each non-space character
+
+    # Char locs of the first and last character of each token
+    token_ends = np.cumsum(token_lens)
+    first_locs = nonspace_locs[token_ends - token_lens]
+    last_locs = nonspace_locs[token_ends - 1]
+
+    mapping = np.full(len(codes), -1, dtype=np.int32)
+    if (last_locs - first_locs + 1 == token_lens).all():
+        # Usual case: no token has spaces in the middle of it
+        mapping[nonspace_locs] = np.repeat(np.arange(len(context_tokens), dtype=np.int32), token_lens)
+    else:
+        # A token with spaces in the middle is mapped from the len(token) character locations ending at its last character
+        for token_idx, (last_loc, token_len) in enumerate(zip(last_locs, token_lens)):
+            mapping[last_loc-token_len+1 : last_loc+1] = token_idx
 
+    return mapping
 
-def preprocess_and_write(dataset, tier, out_dir):
-    """Reads the dataset, extracts context, question, answer, tokenizes them,
-    and calculates answer span in terms of token indices.
-    Note: due to tokenization issues, and the fact that the original answer
-    spans are given in terms of characters, some examples are discarded because
-    we cannot get a clean span in terms of tokens.
 
-    This function produces the {train/dev}.{context/question/answer/span} files.
+def preprocess_article(article):
+    """Extracts, tokenizes and aligns the (context, question, answer) triples of one article.
+    This is run in the worker processes by preprocess_and_write.
 
     Inputs:
-      dataset: read from JSON
-      tier: string ("train" or "dev")
-      out_dir: directory to write the preprocessed files
+      article: one article (with "paragraphs") from the JSON
+
     Returns:
-      the number of (context, question, answer) triples written to file by the dataset.
+      examples: list of (context, question, answer, answer_span) tuples of strings, ready to write to file
+      num_mappingprob, num_tokenprob, num_spanalignprob: ints. Number of triples discarded for each reason (see preprocess_and_write)
     """
-
-    num_exs = 0 # number of examples written to file
-    num_mappingprob, num_tokenprob, num_spanalignprob = 0, 0, 0
     examples = []
+    num_mappingprob, num_tokenprob, num_spanalignprob = 0, 0, 0
+
+    article_paragraphs = article['paragraphs']
+    for pid in range(len(article_paragraphs)):
+
+        context = unicode(article_paragraphs[pid]['context']) # string
+
+        # The following replacements are suggested in the paper
+        # BidAF (Seo et al., 2016)
+        context = context.replace("''", '" ')
+        context = context.replace("``", '" ')
 
-    for articles_id in tqdm(range(len(dataset['data'])), desc="Preprocessing {}".format(tier)):
+        context_tokens = tokenize(context) # list of strings (lowercase)
+        context = context.lower()
 
-        article_paragraphs = dataset['data'][articles_id]['paragraphs']
-        for pid in range(len(article_paragraphs)):
+        qas = article_paragraphs[pid]['qas'] # list of questions
 
-            context = unicode(article_paragraphs[pid]['context']) # string
+        charloc2wordloc = get_char_word_loc_mapping(context, context_tokens) # charloc2wordloc maps the character location (int) of a context token to the word loc (int) of that token, or -1
 
-            # The following replacements are suggested in the paper
-            # BidAF (Seo et al., 2016)
-            context = context.replace("''", '" ')
-            context = context.replace("``", '" ')
+        if charloc2wordloc is None: # there was a problem
+            num_mappingprob += len(qas)
+            continue # skip this context example
 
-            context_tokens = tokenize(context) # list of strings (lowercase)
-            context = context.lower()
+        # for each question, process the question and answer
+        for qn in qas:
 
-            qas = article_paragraphs[pid]['qas'] # list of questions
+            # read the question text and tokenize
+            question = unicode(qn['question']) # string
+            question_tokens = tokenize(question) # list of strings
 
-            charloc2wordloc = get_char_word_loc_mapping(context, context_tokens) # charloc2wordloc maps the character location (int) of a context token to a pair giving (word (string), word loc (int)) of that token
+            # of the three answers, just take the first
+            ans_text = unicode(qn['answers'][0]['text']).lower() # get the answer text
+            ans_start_charloc = qn['answers'][0]['answer_start'] # answer start loc (character count)
+            ans_end_charloc = ans_start_charloc + len(ans_text) # answer end loc (character count) (exclusive)
 
-            if charloc2wordloc is None: # there was a problem
-                num_mappingprob += len(qas)
-                continue # skip this context example
+            # Check that the provided character spans match the provided answer text
+            if context[ans_start_charloc:ans_end_charloc] != ans_text:
+              # Sometimes this is misaligned, mostly because "narrow builds" of Python 2 interpret certain Unicode characters to have length 2 https://stackoverflow.com/questions/29109944/python-returns-length-of-2-for-single-unicode-character-string
+              # We should upgrade to Python 3 next year!
+              num_spanalignprob += 1
+              continue
 
-            # for each question, process the question and answer and write to file
-            for qn in qas:
+            # get word locs for answer start and end (inclusive)
+            ans_start_wordloc = int(charloc2wordloc[ans_start_charloc]) # answer start word loc
+            ans_end_wordloc = int(charloc2wordloc[ans_end_charloc-1]) # answer end word loc
+            if ans_start_wordloc == -1 or ans_end_wordloc == -1:
+                # The answer starts or ends with a space, so it isn't aligned with the tokens
+                num_spanalignprob += 1
+                continue
+            assert ans_start_wordloc <= ans_end_wordloc
 
-                # read the question text and tokenize
-                question = unicode(qn['question']) # string
-                question_tokens = tokenize(question) # list of strings
+            # Check retrieved answer tokens match the provided answer text.
+            # Sometimes they won't match, e.g. if the context contains the phrase "fifth-generation"
+            # and the answer character span is around "generation",
+            # but the tokenizer regards "fifth-generation" as a single token.
+            # Then ans_tokens has "fifth-generation" but the ans_text is "generation", which doesn't match.
+            ans_tokens = context_tokens[ans_start_wordloc:ans_end_wordloc+1]
+            if "".join(ans_tokens) != "".join(ans_text.split()):
+                num_tokenprob += 1
+                continue # skip this question/answer pair
 
-                # of the three answers, just take the first
-                ans_text = unicode(qn['answers'][0]['text']).lower() # get the answer text
-                ans_start_charloc = qn['answers'][0]['answer_start'] # answer start loc (character count)
-                ans_end_charloc = ans_start_charloc + len(ans_text) # answer end loc (character count) (exclusive)
+            examples.append((' '.join(context_tokens), ' '.join(question_tokens), ' '.join(ans_tokens), ' '.join([str(ans_start_wordloc), str(ans_end_wordloc)])))
 
-                # Check that the provided character spans match the provided answer text
-                if context[ans_start_charloc:ans_end_charloc] != ans_text:
-                  # Sometimes this is misaligned, mostly because "narrow builds" of Python 2 interpret certain Unicode characters to have length 2 https://stackoverflow.com/questions/29109944/python-returns-length-of-2-for-single-unicode-character-string
-                  # We should upgrade to Python 3 next year!
-                  num_spanalignprob += 1
-                  continue
+    return examples, num_mappingprob, num_tokenprob, num_spanalignprob
 
-                # get word locs for answer start and end (inclusive)
-                ans_start_wordloc = charloc2wordloc[ans_start_charloc][1] # answer start word loc
-                ans_end_wordloc = charloc2wordloc[ans_end_charloc-1][1] # answer end word loc
-                assert ans_start_wordloc <= ans_end_wordloc
 
-                # Check retrieved answer tokens match the provided answer text.
-                # Sometimes they won't match, e.g. if the context contains the phrase "fifth-generation"
-                # and the answer character span is around "generation",
-                # but the tokenizer regards "fifth-generation" as a single token.
-                # Then ans_tokens has "fifth-generation" but the ans_text is "generation", which doesn't match.
-                ans_tokens = context_tokens[ans_start_wordloc:ans_end_wordloc+1]
-                if "".join(ans_tokens) != "".join(ans_text.split()):
-                    num_tokenprob += 1
-                    continue # skip this question/answer pair
+def preprocess_and_write(dataset, tier, out_dir, num_workers=1):
+    """Reads the dataset, extracts context, question, answer, tokenizes them,
+    and calculates answer span in terms of token indices.
+    Note: due to tokenization issues, and the fact that the original answer
+    spans are given in terms of characters, some examples are discarded because
+    we cannot get a clean span in terms of tokens.
+
+    This function produces the {train/dev}.{context/question/answer/span} files.
+
+    The articles can be processed in a pool of worker processes. The results are merged in article order,
+    so the output files are the same whatever the number of workers.
+
+    Inputs:
+      dataset: read from JSON
+      tier: string ("train" or "dev")
+      out_dir: directory to write the preprocessed files
+      num_workers: int. Number of worker processes. If 1, process the articles in this process.
+    Returns:
+      the number of (context, question, answer) triples written to file by the dataset.
+    """
+
+    num_exs = 0 # number of examples written to file
+    num_mappingprob, num_tokenprob, num_spanalignprob = 0, 0, 0
+    examples = []
+
+    articles = dataset['data']
+    if num_workers == 1:
+        pool = None
+        results = (preprocess_article(article) for article in articles)
+    else:
+        pool = multiprocessing.Pool(num_workers)
+        results = pool.imap(preprocess_article, articles, chunksize=4) # imap returns the results in order
 
-                examples.append((' '.join(context_tokens), ' '.join(question_tokens), ' '.join(ans_tokens), ' '.join([str(ans_start_wordloc), str(ans_end_wordloc)])))
+    for article_examples, article_mappingprob, article_tokenprob, article_spanalignprob in tqdm(results, total=len(articles), desc="Preprocessing {}".format(tier)):
+        examples.extend(article_examples)
+        num_mappingprob += article_mappingprob
+        num_tokenprob += article_tokenprob
+        num_spanalignprob += article_spanalignprob
+    num_exs = len(examples)
 
-                num_exs += 1
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     print "Number of (context, question, answer) triples discarded due to char -> token mapping problems: ", num_mappingprob
     print "Number of (context, question, answer) triples discarded because character-based answer span is unaligned with tokenization: ", num_tokenprob
@@ -256,6 +311,7 @@ def preprocess_and_write(dataset, tier, out_dir):
 
 def main():
     args = setup_args()
+    num_workers = args.num_workers or multiprocessing.cpu_count()
 
     print "Will download SQuAD datasets to {}".format(args.data_dir)
     print "Will put preprocessed SQuAD datasets in {}".format(args.data_dir)
@@ -274,7 +330,7 @@ def main():
     print "Train data has %i examples total" % total_exs(train_data)
 
     # preprocess train set and write to file
-    preprocess_and_write(train_data, 'train', args.data_dir)
+    preprocess_and_write(train_data, 'train', args.data_dir, num_workers)
 
     # download dev set
     maybe_download(SQUAD_BASE_URL, dev_filename, args.data_dir, 4854279L)
@@ -284,7 +340,7 @@ def main():
     print "Dev data has %i examples total" % total_exs(dev_data)
 
     # preprocess dev set and write to file
-    preprocess_and_write(dev_data, 'dev', args.data_dir)
+    preprocess_and_write(dev_data, 'dev', args.data_dir, num_workers)
 
 
 if __name__ == '__main__':
@@ -22,15 +22,20 @@ import time
 import logging
 import os
 import sys
+import json
 
 import numpy as np
+from six.moves import xrange
 import tensorflow as tf
 from tensorflow.python.ops import variable_scope as vs
 from tensorflow.python.ops import embedding_ops
 
 from evaluate import exact_match_score, f1_score
-from data_batcher import get_batch_generator
+from data_batcher import get_batch_generator, get_sample_batch_generator, PrefetchingBatchGenerator, dedup_contexts
+from context_cache import context_key
+from packed_data import get_packed_data, get_packed_batch_generator
 from pretty_print import print_example
+from span_decoder import decode_band, decode_dense
 from modules import RNNEncoder, SimpleSoftmaxLayer, BasicAttn, BiDAFAttn, LSTMEncoder
 
 logging.basicConfig(level=logging.INFO)
@@ -39,7 +44,7 @@ logging.basicConfig(level=logging.INFO)
 class QAModel(object):
     """Top-level Question Answering module"""
 
-    def __init__(self, FLAGS, id2word, word2id, emb_matrix, train_ans_path):
+    def __init__(self, FLAGS, id2word, word2id, emb_matrix, train_ans_path, ans_len_dist_path=""):
         """
         Initializes the QA model.
 
@@ -48,16 +53,29 @@ class QAModel(object):
           id2word: dictionary mapping word idx (int) to word (string)
           word2id: dictionary mapping word (string) to word idx (int)
           emb_matrix: numpy array shape (400002, embedding_size) containing pre-traing GloVe embeddings
+          train_ans_path: path to train.span, to get the answer length distribution from
+            if there's no file at ans_len_dist_path
+          ans_len_dist_path: path to the answer length distribution saved with the checkpoint (see write_ans_len_dist)
         """
         print "Initializing the QAModel..."
         self.FLAGS = FLAGS
         self.id2word = id2word
         self.word2id = word2id
 
-        with open(train_ans_path, 'r') as f:
-            self.train_ans_len_dist = collections.Counter(
-                map((lambda t: int(t[1])-int(t[0])+1),
-                    (line.strip().split() for line in f)))
+        # Answer length distribution of the training set, loaded when it's first needed (see train_ans_len_dist)
+        self.train_ans_path = train_ans_path
+        self.ans_len_dist_path = ans_len_dist_path
+        self._train_ans_len_dist = None
+
+        # Answer-length prior used when decoding spans (see get_ans_len_probs)
+        self._ans_len_probs = None
+        self._ans_len_probs_power = None
+        self._ans_len_prior = None
+        self._ans_len_prior_key = None
+
+        # Optional ContextEncodingCache, used by the inference methods (see add_cached_context_feed).
+        # Only set this when the weights aren't changing, e.g. in official_eval mode.
+        self.context_cache = None
 
         # Add all parts of the graph
         with tf.variable_scope("QAModel", initializer=tf.contrib.layers.variance_scaling_initializer(factor=1.0, uniform=True)):
@@ -65,6 +83,8 @@ class QAModel(object):
             self.add_embedding_layer(emb_matrix)
             self.build_graph()
             self.add_loss()
+            if FLAGS.decode_in_graph:
+                self.add_span_decoder()
 
         # Define trainable parameters, gradient, gradient norm, and clip by gradient norm
         params = tf.trainable_variables()
@@ -90,14 +110,20 @@ class QAModel(object):
         Add placeholders to the graph. Placeholders are used to feed in inputs.
         """
         # Add placeholders for inputs.
-        # These are all batch-first: the None corresponds to batch_size and
-        # allows you to run the same model with variable batch_size
-        self.context_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.context_len])
-        self.context_mask = tf.placeholder(tf.int32, shape=[None, self.FLAGS.context_len])
-        self.qn_ids = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len])
-        self.qn_mask = tf.placeholder(tf.int32, shape=[None, self.FLAGS.question_len])
+        # These are all batch-first: the first None corresponds to batch_size and
+        # allows you to run the same model with variable batch_size.
+        # The second None is the (padded) context or question length, which is at most
+        # context_len or question_len, but can be less if batches are padded to their own max length
+        self.context_ids = tf.placeholder(tf.int32, shape=[None, None])
+        self.context_mask = tf.placeholder(tf.int32, shape=[None, None])
+        self.qn_ids = tf.placeholder(tf.int32, shape=[None, None])
+        self.qn_mask = tf.placeholder(tf.int32, shape=[None, None])
         self.ans_span = tf.placeholder(tf.int32, shape=[None, 2])
 
+        # context_ids and context_mask can hold just the distinct contexts in the batch (see data_batcher.dedup_contexts),
+        # in which case context_index says which of them each example uses. By default, example i uses context i.
+        self.context_index = tf.placeholder_with_default(tf.range(tf.shape(self.context_ids)[0]), shape=[None])
+
         # Add a placeholder to feed in the keep probability (for dropout).
         # This is necessary so that we can instruct the model to use dropout when training, but not when testing
         self.keep_prob = tf.placeholder_with_default(1.0, shape=())
@@ -113,15 +139,31 @@ class QAModel(object):
         """
         with vs.variable_scope("embeddings"):
 
-            # Note: the embedding matrix is a tf.constant which means it's not a trainable parameter
-            embedding_matrix = tf.constant(emb_matrix, dtype=tf.float32, name="emb_matrix") # shape (400002, embedding_size)
+            # Note: the embedding matrix is a non-trainable variable which is initialized from a placeholder (see init_embeddings).
+            # Unlike a tf.constant, this means the matrix isn't serialized into the GraphDef (or the TensorBoard graph).
+            # It's also kept out of the global variables collection, so it isn't saved in checkpoints.
+            self.emb_matrix = emb_matrix
+            self.emb_matrix_placeholder = tf.placeholder(tf.float32, shape=emb_matrix.shape)
+            embedding_matrix = tf.Variable(self.emb_matrix_placeholder, trainable=False, collections=[], name="emb_matrix") # shape (400002, embedding_size)
+            self.embedding_matrix = embedding_matrix
 
             # Get the word embeddings for the context and question,
             # using the placeholders self.context_ids and self.qn_ids
-            self.context_embs = embedding_ops.embedding_lookup(embedding_matrix, self.context_ids) # shape (batch_size, context_len, embedding_size)
+            self.context_embs = embedding_ops.embedding_lookup(embedding_matrix, self.context_ids) # shape (num_contexts, context_len, embedding_size)
             self.qn_embs = embedding_ops.embedding_lookup(embedding_matrix, self.qn_ids) # shape (batch_size, question_len, embedding_size)
 
 
+    def init_embeddings(self, session):
+        """
+        Initializes the embedding matrix variable by feeding in the numpy embedding matrix.
+        This needs to be called whenever the other variables are initialized or restored from a checkpoint.
+
+        Inputs:
+          session: TensorFlow session
+        """
+        session.run(self.embedding_matrix.initializer, {self.emb_matrix_placeholder: self.emb_matrix})
+
+
     def build_graph(self):
         """Builds the main part of the graph for the model, starting from the input embeddings to the final distributions for the answer span.
 
@@ -138,15 +180,23 @@ class QAModel(object):
         # between the context and the question.
         with vs.variable_scope("Context"):
             encoder = LSTMEncoder(self.FLAGS.preatt_hidden_size, self.keep_prob)
-            # (batch_size, context_len, context_hidden_size*2)
-            context_hiddens = encoder.build_graph(self.context_embs, self.context_mask)
+            # Encode each distinct context once, then gather them for each example
+            # This is the output of the context-encoding stage: everything after it depends on the question.
+            # Feeding it directly (see add_cached_context_feed) skips the context embedding and LSTM.
+            # (num_contexts, context_len, preatt_hidden_size*2)
+            self.uniq_context_hiddens = encoder.build_graph(self.context_embs, self.context_mask)
+            # (batch_size, context_len, preatt_hidden_size*2)
+            context_hiddens = tf.gather(self.uniq_context_hiddens, self.context_index)
             # (batch_size, question_len, preatt_hidden_size*2)
             question_hiddens = encoder.build_graph(self.qn_embs, self.qn_mask)
 
+        # The context mask for each example. shape (batch_size, context_len)
+        context_mask = tf.gather(self.context_mask, self.context_index)
+
         # Use context hidden states to attend to question hidden states
         attn_layer = BiDAFAttn(self.keep_prob, self.FLAGS.preatt_hidden_size*2, self.FLAGS.preatt_hidden_size*2)
         # attn_output is shape (batch_size, context_len, preatt_hidden_size*2)
-        _, attn_output = attn_layer.build_graph(question_hiddens, self.qn_mask, context_hiddens, self.context_mask)
+        _, attn_output = attn_layer.build_graph(question_hiddens, self.qn_mask, context_hiddens, context_mask)
 
         # Concat attn_output to context_hiddens to get blended_reps
         # (batch_size, context_len, preatt_hidden_size*4)
@@ -158,19 +208,19 @@ class QAModel(object):
         # blended_reps_final is shape (batch_size, context_len, postatt_hidden_size)
         with vs.variable_scope("ModellingLayer"):
             model_encoder = LSTMEncoder(self.FLAGS.postatt_hidden_size, self.keep_prob)
-            blended_reps_final = model_encoder.build_graph(blended_reps, self.context_mask)
+            blended_reps_final = model_encoder.build_graph(blended_reps, context_mask)
 
         # Use softmax layer to compute probability distribution for start location
         # Note this produces self.logits_start and self.probdist_start, both of which have shape (batch_size, context_len)
         with vs.variable_scope("StartDist"):
             softmax_layer_start = SimpleSoftmaxLayer()
-            self.logits_start, self.probdist_start = softmax_layer_start.build_graph(blended_reps_final, self.context_mask)
+            self.logits_start, self.probdist_start = softmax_layer_start.build_graph(blended_reps_final, context_mask)
 
         # Use softmax layer to compute probability distribution for end location
         # Note this produces self.logits_end and self.probdist_end, both of which have shape (batch_size, context_len)
         with vs.variable_scope("EndDist"):
             softmax_layer_end = SimpleSoftmaxLayer()
-            self.logits_end, self.probdist_end = softmax_layer_end.build_graph(blended_reps_final, self.context_mask)
+            self.logits_end, self.probdist_end = softmax_layer_end.build_graph(blended_reps_final, context_mask)
 
 
     def add_loss(self):
@@ -191,6 +241,7 @@ class QAModel(object):
 
         Defines:
           self.loss_start, self.loss_end, self.loss: all scalar tensors
+          self.example_loss: shape (batch_size). The loss for each example (start + end)
         """
         with vs.variable_scope("loss"):
 
@@ -206,9 +257,116 @@ class QAModel(object):
 
             # Add the two losses
             self.loss = self.loss_start + self.loss_end
+            self.example_loss = loss_start + loss_end # shape (batch_size)
             tf.summary.scalar('loss', self.loss)
 
 
+    def add_span_decoder(self):
+        """
+        Add in-graph span decoding, so that session.run can return the most likely
+        answer spans directly rather than the full start and end distributions.
+        Only added if FLAGS.decode_in_graph.
+
+        Like span_decoder.decode_band, but in log space: the score of the span (start, end)
+        is log p_start(start) + log p_end(end) + log prior(end-start+1), and only spans with
+        end >= start and length <= get_max_answer_len() (all lengths if 0) are scored.
+
+        Uses:
+          self.logits_start, self.logits_end: shape (batch_size, context_len). Masked logits.
+
+        Defines:
+          self.ans_len_log_probs: placeholder shape (max answer length).
+            Entry i is the log prior probability of an answer of length i+1.
+          self.span_top_k: placeholder (defaults to 1). How many spans to return per example.
+          self.topk_start, self.topk_end, self.topk_scores: all shape (batch_size, span_top_k).
+            The best spans for each example, best first, with their (log) scores.
+        """
+        with vs.variable_scope("SpanDecoder"):
+            max_answer_len = self.get_max_answer_len()
+            max_len = max_answer_len if max_answer_len > 0 else self.FLAGS.context_len
+            max_len = min(max_len, self.FLAGS.context_len)
+
+            self.ans_len_log_probs = tf.placeholder(tf.float32, shape=[max_len])
+            self.span_top_k = tf.placeholder_with_default(1, shape=())
+
+            # Note: logits are -large in the pad locations, so these log probs are too
+            log_start = tf.nn.log_softmax(self.logits_start) # shape (batch_size, context_len)
+            log_end = tf.nn.log_softmax(self.logits_end) # shape (batch_size, context_len)
+
+            # end_windows[b, s, k] = log_end[b, s+k]. Spans that run off the end get -large.
+            context_len = tf.shape(log_end)[1]
+            log_end_padded = tf.pad(log_end, [[0, 0], [0, max_len-1]], constant_values=-1e30) # shape (batch_size, context_len+max_len-1)
+            end_windows = tf.stack([log_end_padded[:, k:k+context_len] for k in range(max_len)], axis=2) # shape (batch_size, context_len, max_len)
+
+            # scores[b, s, k] is the score of the span (s, s+k). shape (batch_size, context_len, max_len)
+            scores = tf.expand_dims(log_start, 2) + end_windows + tf.reshape(self.ans_len_log_probs, [1, 1, max_len])
+            scores = tf.reshape(scores, [tf.shape(scores)[0], -1]) # shape (batch_size, context_len*max_len)
+
+            self.topk_scores, locations = tf.nn.top_k(scores, k=self.span_top_k) # both shape (batch_size, span_top_k)
+            self.topk_start = locations // max_len
+            self.topk_end = self.topk_start + locations % max_len
+
+
+    def add_context_feed(self, input_feed, batch):
+        """
+        Adds the batch's contexts to input_feed.
+        If the batch is deduplicated (see data_batcher.dedup_contexts), only feeds the distinct contexts,
+        so that the context LSTM runs once per distinct context.
+
+        Inputs:
+          input_feed: dictionary mapping placeholders to values
+          batch: a Batch object
+        """
+        if batch.context_index is not None:
+            input_feed[self.context_ids] = batch.uniq_context_ids
+            input_feed[self.context_mask] = batch.uniq_context_mask
+            input_feed[self.context_index] = batch.context_index
+        else:
+            input_feed[self.context_ids] = batch.context_ids
+            input_feed[self.context_mask] = batch.context_mask
+
+
+    def add_cached_context_feed(self, session, input_feed, batch):
+        """
+        Like add_context_feed, but feeds the context encodings (self.uniq_context_hiddens) from self.context_cache,
+        so that the context LSTM only runs for contexts that aren't in the cache.
+        Only for inference: the context encodings are computed without dropout.
+
+        Inputs:
+          session: TensorFlow session
+          input_feed: dictionary mapping placeholders to values
+          batch: a Batch object. Deduplicated if it wasn't already.
+        """
+        if batch.context_index is None:
+            dedup_contexts(batch)
+        uniq_context_ids, uniq_context_mask = batch.uniq_context_ids, batch.uniq_context_mask
+        context_lens = uniq_context_mask.sum(axis=1)
+
+        # Look up each distinct context in the cache
+        keys = [context_key(ids[:length]) for ids, length in zip(uniq_context_ids, context_lens)]
+        encodings = [self.context_cache.get(key) for key in keys]
+
+        # Encode the contexts that weren't cached, and cache them (without padding)
+        missing = [idx for idx, encoding in enumerate(encodings) if encoding is None]
+        if missing:
+            missing_len = context_lens[missing].max()
+            missing_feed = {self.context_ids: uniq_context_ids[missing, :missing_len], self.context_mask: uniq_context_mask[missing, :missing_len]}
+            missing_hiddens = session.run(self.uniq_context_hiddens, missing_feed)
+            for idx, hiddens in zip(missing, missing_hiddens):
+                encodings[idx] = hiddens[:context_lens[idx]].copy()
+                self.context_cache.put(keys[idx], encodings[idx])
+
+        # Pad to the batch's context length. The LSTM's outputs are zero after the end of the sequence, so pad with zeros.
+        hidden_size = encodings[0].shape[1]
+        uniq_context_hiddens = np.zeros(uniq_context_ids.shape + (hidden_size,), dtype=np.float32)
+        for idx, encoding in enumerate(encodings):
+            uniq_context_hiddens[idx, :len(encoding)] = encoding
+
+        input_feed[self.uniq_context_hiddens] = uniq_context_hiddens
+        input_feed[self.context_mask] = uniq_context_mask
+        input_feed[self.context_index] = batch.context_index
+
+
     def run_train_iter(self, session, batch, summary_writer):
         """
         This performs a single training iteration (forward pass, loss computation, backprop, parameter update)
@@ -226,8 +384,7 @@ class QAModel(object):
         """
         # Match up our input data with the placeholders
         input_feed = {}
-        input_feed[self.context_ids] = batch.context_ids
-        input_feed[self.context_mask] = batch.context_mask
+        self.add_context_feed(input_feed, batch)
         input_feed[self.qn_ids] = batch.qn_ids
         input_feed[self.qn_mask] = batch.qn_mask
         input_feed[self.ans_span] = batch.ans_span
@@ -258,8 +415,7 @@ class QAModel(object):
         """
 
         input_feed = {}
-        input_feed[self.context_ids] = batch.context_ids
-        input_feed[self.context_mask] = batch.context_mask
+        self.add_context_feed(input_feed, batch)
         input_feed[self.qn_ids] = batch.qn_ids
         input_feed[self.qn_mask] = batch.qn_mask
         input_feed[self.ans_span] = batch.ans_span
@@ -284,8 +440,10 @@ class QAModel(object):
           probdist_start and probdist_end: both shape (batch_size, context_len)
         """
         input_feed = {}
-        input_feed[self.context_ids] = batch.context_ids
-        input_feed[self.context_mask] = batch.context_mask
+        if self.context_cache is not None:
+            self.add_cached_context_feed(session, input_feed, batch)
+        else:
+            self.add_context_feed(input_feed, batch)
         input_feed[self.qn_ids] = batch.qn_ids
         input_feed[self.qn_mask] = batch.qn_mask
         # note you don't supply keep_prob here, so it will default to 1 i.e. no dropout
@@ -295,10 +453,150 @@ class QAModel(object):
         return probdist_start, probdist_end
 
 
+    @property
+    def train_ans_len_dist(self):
+        """
+        The answer length distribution of the training set: a Counter mapping answer length (int) to count.
+
+        Read from ans_len_dist_path if it exists (so inference doesn't need the training data),
+        otherwise computed from train_ans_path.
+        """
+        if self._train_ans_len_dist is None:
+            if self.ans_len_dist_path and os.path.exists(self.ans_len_dist_path):
+                self._train_ans_len_dist = read_ans_len_dist(self.ans_len_dist_path)
+            else:
+                print "Computing the answer length distribution from %s..." % self.train_ans_path
+                self._train_ans_len_dist = get_ans_len_dist(self.train_ans_path)
+        return self._train_ans_len_dist
+
+
+    def get_max_answer_len(self):
+        """
+        Returns the longest answer span (in tokens) that the band span decoders consider:
+        FLAGS.max_answer_len if it's set, otherwise (if it's -1) the longest answer in the training set.
+        0 means no limit.
+        """
+        if self.FLAGS.max_answer_len >= 0:
+            return self.FLAGS.max_answer_len
+        return max(self.train_ans_len_dist.keys()) if self.train_ans_len_dist else 0
+
+
+    def get_ans_len_probs(self, power=None):
+        """
+        Get the answer-length prior as a function of answer length.
+
+        The prior is built with numpy from self.train_ans_len_dist (with "laplace smoothing")
+        and raised to FLAGS.ans_len_dist_power. It is cached on the model, and only
+        rebuilt when the power changes, so official_eval,
+        check_f1_em and the power search all share the same precomputed array.
+
+        Inputs:
+          power: float. If given, use this power instead of FLAGS.ans_len_dist_power.
+
+        Returns:
+          ans_len_probs: numpy array shape (context_len).
+            Entry i is the prior probability of an answer of length i+1.
+        """
+        power = self.FLAGS.ans_len_dist_power if power is None else power
+        if self._ans_len_probs_power != power:
+            total = sum(self.train_ans_len_dist.values())
+            counts = np.array([self.train_ans_len_dist[l] for l in xrange(1, self.FLAGS.context_len+1)], dtype=np.float64)
+            self._ans_len_probs = ((counts+1.0)/(total+self.FLAGS.context_len)) ** power
+            self._ans_len_probs_power = power
+
+        return self._ans_len_probs
+
+
+    def get_ans_len_prior(self, context_len, power=None):
+        """
+        Get the answer-length prior that the dense span decoder multiplies into the
+        outer product of the start and end distributions.
+        Cached on the model, and only rebuilt when context_len or the power changes.
+
+        Inputs:
+          context_len: int. Size of the (square) prior to return.
+          power: float. If given, use this power instead of FLAGS.ans_len_dist_power.
+
+        Returns:
+          ans_len_prior: numpy array shape (context_len, context_len).
+            Entry [start, end] is the prior probability of an answer of length end-start+1,
+            and 0 where end < start.
+        """
+        power = self.FLAGS.ans_len_dist_power if power is None else power
+        key = (context_len, power)
+        if self._ans_len_prior_key != key:
+            len_probs = self.get_ans_len_probs(power)
+            offsets = np.arange(context_len)[np.newaxis, :] - np.arange(context_len)[:, np.newaxis] # end - start
+            self._ans_len_prior = np.where(offsets >= 0, len_probs[np.maximum(offsets, 0)], 0.)
+            self._ans_len_prior_key = key
+
+        return self._ans_len_prior
+
+
+    def get_top_spans(self, session, batch, k):
+        """
+        Run forward-pass only; get the k most likely answer spans, decoded in the graph.
+        Needs FLAGS.decode_in_graph (see add_span_decoder).
+
+        Inputs:
+          session: TensorFlow session
+          batch: Batch object
+          k: int. Number of spans to return per example.
+
+        Returns:
+          start_pos, end_pos, scores: all numpy arrays shape (batch_size, k).
+            The k best spans for each example (best first), and their log scores.
+        """
+        if not self.FLAGS.decode_in_graph:
+            raise Exception("get_top_spans needs the in-graph span decoder. Set --decode_in_graph")
+
+        ans_len_log_probs = np.log(self.get_ans_len_probs()[:self.ans_len_log_probs.get_shape()[0].value])
+
+        input_feed = {}
+        if self.context_cache is not None:
+            self.add_cached_context_feed(session, input_feed, batch)
+        else:
+            self.add_context_feed(input_feed, batch)
+        input_feed[self.qn_ids] = batch.qn_ids
+        input_feed[self.qn_mask] = batch.qn_mask
+        input_feed[self.ans_len_log_probs] = ans_len_log_probs
+        input_feed[self.span_top_k] = k
+        # note you don't supply keep_prob here, so it will default to 1 i.e. no dropout
+
+        output_feed = [self.topk_start, self.topk_end, self.topk_scores]
+        [start_pos, end_pos, scores] = session.run(output_feed, input_feed)
+        return start_pos, end_pos, scores
+
+
+    def decode_spans(self, start_dist, end_dist, power=None):
+        """
+        Get the most likely answer spans from the start and end distributions, in numpy,
+        according to FLAGS.span_decoder:
+          "band": only score spans of length <= get_max_answer_len() (see span_decoder.decode_band)
+          "dense": score every (start, end) pair (see span_decoder.decode_dense)
+
+        Inputs:
+          start_dist, end_dist: numpy arrays shape (batch_size, context_len)
+          power: float. If given, raise the answer-length prior to this power instead of FLAGS.ans_len_dist_power.
+
+        Returns:
+          start_pos, end_pos: both numpy arrays shape (batch_size).
+        """
+        if self.FLAGS.span_decoder == "band":
+            return decode_band(start_dist, end_dist, self.get_ans_len_probs(power), self.get_max_answer_len())
+        elif self.FLAGS.span_decoder == "dense":
+            return decode_dense(start_dist, end_dist, self.get_ans_len_prior(start_dist.shape[1], power))
+        else:
+            raise Exception("Unexpected value of FLAGS.span_decoder: %s" % self.FLAGS.span_decoder)
+
+
     def get_start_end_pos(self, session, batch):
         """
         Run forward-pass only; get the most likely answer span.
 
+        If FLAGS.decode_in_graph, the span is decoded in the graph (see add_span_decoder).
+        Otherwise it is decoded in numpy (see decode_spans).
+
         Inputs:
           session: TensorFlow session
           batch: Batch object
@@ -307,70 +605,87 @@ class QAModel(object):
           start_pos, end_pos: both numpy arrays shape (batch_size).
             The most likely start and end positions for each example in the batch.
         """
-
-        def get_ans_len_prob(start, end):
-            if end < start:
-                return 0
-            else:
-                count = self.train_ans_len_dist[end-start+1]
-                total = sum(self.train_ans_len_dist.values())
-                # "laplace smoothing"
-                return (((count+1.0)/(total+self.FLAGS.context_len))
-                        ** self.FLAGS.ans_len_dist_power)
+        # Decode in the graph, so we only fetch the spans
+        if self.FLAGS.decode_in_graph:
+            start_pos, end_pos, _ = self.get_top_spans(session, batch, 1)
+            return start_pos[:, 0], end_pos[:, 0]
 
         # Get start_dist and end_dist, both shape (batch_size, context_len)
         start_dist, end_dist = self.get_prob_dists(session, batch)
 
         # Take argmax to get start_pos and end_post, both shape (batch_size)
-        ans_len_dist = np.array([[get_ans_len_prob(s, e)
-                for e in range(self.FLAGS.context_len)]
-                for s in range(self.FLAGS.context_len)])
-        range_dist = np.array([(np.outer(S, E) * ans_len_dist).flatten()
-                for S, E in zip(start_dist, end_dist)])
-        locations = np.argmax(range_dist, axis=1)
-        start_pos = locations // self.FLAGS.context_len
-        end_pos = locations % self.FLAGS.context_len
+        return self.decode_spans(start_dist, end_dist)
 
-        return start_pos, end_pos
 
-
-    def get_dev_loss(self, session, dev_context_path, dev_qn_path, dev_ans_path):
+    def get_dev_loss_f1_em(self, session, dev_context_path, dev_qn_path, dev_ans_path):
         """
-        Get loss for entire dev set.
+        Get loss, F1 and EM for the entire dev set, in one pass over it.
+
+        Long examples are truncated rather than discarded. The loss is undefined for an example
+        whose gold span is cut off the context, so the loss is averaged over the examples whose
+        gold span survives truncation, while F1 and EM are averaged over all the examples
+        (as in check_f1_em with num_samples=0).
 
         Inputs:
           session: TensorFlow session
           dev_qn_path, dev_context_path, dev_ans_path: paths to the dev.{context/question/answer} data files
 
-        Outputs:
-          dev_loss: float. Average loss across the dev set.
+        Returns:
+          dev_loss: float. Average loss across the examples whose gold span survives truncation.
+            NaN if there are none.
+          dev_f1, dev_em: floats. Average F1 and EM across all the examples.
         """
-        logging.info("Calculating dev loss...")
+        logging.info("Calculating dev loss and F1/EM...")
         tic = time.time()
-        loss_per_batch, batch_lengths = [], []
-
-        # Iterate over dev set batches
-        # Note: here we set discard_long=True, meaning we discard any examples
-        # which are longer than our context_len or question_len.
-        # We need to do this because if, for example, the true answer is cut
-        # off the context, then the loss function is undefined.
-        for batch in get_batch_generator(self.word2id, dev_context_path, dev_qn_path, dev_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True):
-
-            # Get loss for this batch
-            loss = self.get_loss(session, batch)
-            curr_batch_size = batch.batch_size
-            loss_per_batch.append(loss * curr_batch_size)
-            batch_lengths.append(curr_batch_size)
-
-        # Calculate average loss
-        total_num_examples = sum(batch_lengths)
-        toc = time.time()
-        print "Computed dev loss over %i examples in %.2f seconds" % (total_num_examples, toc-tic)
+        loss_total, f1_total, em_total = 0., 0., 0.
+        num_loss_examples, num_examples = 0, 0
+
+        # As in check_f1_em, we select discard_long=False, truncating rather than discarding long examples
+        for batch in get_batch_generator(self.word2id, dev_context_path, dev_qn_path, dev_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=False, bucket_by_length=self.FLAGS.bucket_by_length, max_batch_tokens=self.FLAGS.max_batch_tokens, dedup=self.FLAGS.dedup_contexts):
+
+            # If the gold span was cut off the context, the loss is undefined for that example.
+            # So clip its labels into range (to keep the loss op happy) and leave it out of the average
+            span_kept = batch.ans_span[:, 1] < batch.context_mask.sum(axis=1) # shape (batch_size)
+            ans_span = np.minimum(batch.ans_span, batch.context_ids.shape[1] - 1)
+
+            input_feed = {}
+            self.add_context_feed(input_feed, batch)
+            input_feed[self.qn_ids] = batch.qn_ids
+            input_feed[self.qn_mask] = batch.qn_mask
+            input_feed[self.ans_span] = ans_span
+            # note you don't supply keep_prob here, so it will default to 1 i.e. no dropout
+
+            # Get the per-example losses and the predicted spans from the same forward pass
+            if self.FLAGS.decode_in_graph:
+                input_feed[self.ans_len_log_probs] = np.log(self.get_ans_len_probs()[:self.ans_len_log_probs.get_shape()[0].value])
+                input_feed[self.span_top_k] = 1
+                example_loss, pred_start_pos, pred_end_pos = session.run([self.example_loss, self.topk_start, self.topk_end], input_feed)
+                pred_start_pos, pred_end_pos = pred_start_pos[:, 0], pred_end_pos[:, 0]
+            else:
+                example_loss, start_dist, end_dist = session.run([self.example_loss, self.probdist_start, self.probdist_end], input_feed)
+                pred_start_pos, pred_end_pos = self.decode_spans(start_dist, end_dist)
+
+            loss_total += example_loss[span_kept].sum()
+            num_loss_examples += span_kept.sum()
 
-        # Overall loss is total loss divided by total number of examples
-        dev_loss = sum(loss_per_batch) / float(total_num_examples)
+            for ex_idx, (pred_ans_start, pred_ans_end, true_ans_tokens) in enumerate(zip(pred_start_pos.tolist(), pred_end_pos.tolist(), batch.ans_tokens)):
+                # Compare the original words (no UNKs), as in check_f1_em
+                pred_answer = " ".join(batch.context_tokens[ex_idx][pred_ans_start : pred_ans_end + 1])
+                true_answer = " ".join(true_ans_tokens)
+                f1_total += f1_score(pred_answer, true_answer)
+                em_total += exact_match_score(pred_answer, true_answer)
+            num_examples += batch.batch_size
 
-        return dev_loss
+        toc = time.time()
+        print "Computed dev loss over %i examples and F1/EM over %i examples in %.2f seconds" % (num_loss_examples, num_examples, toc-tic)
+
+        # Don't lose the F1/EM if truncation cut off every gold span (e.g. with a very small context_len)
+        if num_loss_examples == 0:
+            logging.info("No dev examples kept their gold span after truncation, so the dev loss is undefined")
+            dev_loss = float('nan')
+        else:
+            dev_loss = loss_total / float(num_loss_examples)
+        return dev_loss, f1_total / num_examples, em_total / num_examples
 
 
     def check_f1_em(self, session, context_path, qn_path, ans_path, dataset, num_samples=100, print_to_screen=False):
@@ -393,7 +708,8 @@ class QAModel(object):
           session: TensorFlow session
           qn_path, context_path, ans_path: paths to {dev/train}.{question/context/answer} data files.
           dataset: string. Either "train" or "dev". Just for logging purposes.
-          num_samples: int. How many samples to use. If num_samples=0 then do whole dataset.
+          num_samples: int. How many samples to use, chosen at random from the whole dataset
+            (see get_sample_batch_generator). If num_samples=0 then do whole dataset.
           print_to_screen: if True, pretty-prints each example to screen
 
         Returns:
@@ -409,7 +725,13 @@ class QAModel(object):
 
         # Note here we select discard_long=False because we want to sample from the entire dataset
         # That means we're truncating, rather than discarding, examples with too-long context or questions
-        for batch in get_batch_generator(self.word2id, context_path, qn_path, ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=False):
+        # (the sample batch generator always truncates)
+        if num_samples != 0:
+            batches = get_sample_batch_generator(self.word2id, context_path, qn_path, ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, num_samples=num_samples, bucket_by_length=self.FLAGS.bucket_by_length, dedup=self.FLAGS.dedup_contexts)
+        else:
+            batches = get_batch_generator(self.word2id, context_path, qn_path, ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=False, bucket_by_length=self.FLAGS.bucket_by_length, max_batch_tokens=self.FLAGS.max_batch_tokens, dedup=self.FLAGS.dedup_contexts)
+
+        for batch in batches:
 
             pred_start_pos, pred_end_pos = self.get_start_end_pos(session, batch)
 
@@ -486,72 +808,127 @@ class QAModel(object):
 
         epoch = 0
 
+        # Compile the training set into packed arrays of word ids (if we haven't already)
+        # Stored next to the training data, e.g. data/train.packed
+        # Global shuffling needs random access to the training set, so it always uses the packed data
+        use_packed_data = self.FLAGS.packed_data or self.FLAGS.global_shuffle
+        if use_packed_data:
+            train_packed_data = get_packed_data(self.word2id, train_context_path, train_qn_path, train_ans_path, os.path.splitext(train_context_path)[0] + ".packed")
+
+        if self.FLAGS.max_batch_tokens:
+            logging.info("Using token-budget batching: up to %i padded context tokens per batch" % self.FLAGS.max_batch_tokens)
+
         logging.info("Beginning training loop...")
         while self.FLAGS.num_epochs == 0 or epoch < self.FLAGS.num_epochs:
             epoch += 1
             epoch_tic = time.time()
 
-            # Loop over batches
-            for batch in get_batch_generator(self.word2id, train_context_path, train_qn_path, train_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True):
-
-                # Run training iteration
-                iter_tic = time.time()
-                loss, global_step, param_norm, grad_norm = self.run_train_iter(session, batch, summary_writer)
-                iter_toc = time.time()
-                iter_time = iter_toc - iter_tic
-
-                # Update exponentially-smoothed loss
-                if not exp_loss: # first iter
-                    exp_loss = loss
-                else:
-                    exp_loss = 0.99 * exp_loss + 0.01 * loss
-
-                # Sometimes print info to screen
-                if global_step % self.FLAGS.print_every == 0:
-                    logging.info(
-                        'epoch %d, iter %d, loss %.5f, smoothed loss %.5f, grad norm %.5f, param norm %.5f, batch time %.3f' %
-                        (epoch, global_step, loss, exp_loss, grad_norm, param_norm, iter_time))
-
-                # Sometimes save model
-                if global_step % self.FLAGS.save_every == 0:
-                    logging.info("Saving to %s..." % checkpoint_path)
-                    self.saver.save(session, checkpoint_path, global_step=global_step)
-
-                # Sometimes evaluate model on dev loss, train F1/EM and dev F1/EM
-                if global_step % self.FLAGS.eval_every == 0:
+            # Make batches from the packed dataset, or from the text files.
+            # Optionally make batches in a background thread
+            # With global_shuffle, each epoch is a different (but reproducible) permutation of the whole training set
+            if use_packed_data:
+                shuffle_rng = np.random.RandomState([self.FLAGS.shuffle_seed, epoch]) if self.FLAGS.global_shuffle else None
+                batches = get_packed_batch_generator(train_packed_data, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True, bucket_by_length=self.FLAGS.bucket_by_length, max_batch_tokens=self.FLAGS.max_batch_tokens, shuffle_rng=shuffle_rng, dedup=self.FLAGS.dedup_contexts)
+            else:
+                batches = get_batch_generator(self.word2id, train_context_path, train_qn_path, train_ans_path, self.FLAGS.batch_size, context_len=self.FLAGS.context_len, question_len=self.FLAGS.question_len, discard_long=True, bucket_by_length=self.FLAGS.bucket_by_length, max_batch_tokens=self.FLAGS.max_batch_tokens, dedup=self.FLAGS.dedup_contexts)
+            if self.FLAGS.prefetch_batches:
+                batches = PrefetchingBatchGenerator(batches, self.FLAGS.prefetch_batches)
 
-                    # Get loss for entire dev set and log to tensorboard
-                    dev_loss = self.get_dev_loss(session, dev_context_path, dev_qn_path, dev_ans_path)
-                    logging.info("Epoch %d, Iter %d, dev loss: %f" % (epoch, global_step, dev_loss))
-                    write_summary(dev_loss, "dev/loss", summary_writer, global_step)
+            # Loop over batches
+            # data_wait is how long the training loop waited for each batch
+            try:
+                data_tic = time.time()
+                for batch in batches:
+                    data_wait = time.time() - data_tic
+
+                    # Run training iteration
+                    iter_tic = time.time()
+                    loss, global_step, param_norm, grad_norm = self.run_train_iter(session, batch, summary_writer)
+                    iter_toc = time.time()
+                    iter_time = iter_toc - iter_tic
+
+                    # Update exponentially-smoothed loss
+                    if not exp_loss: # first iter
+                        exp_loss = loss
+                    else:
+                        exp_loss = 0.99 * exp_loss + 0.01 * loss
+
+                    # Sometimes print info to screen
+                    if global_step % self.FLAGS.print_every == 0:
+                        logging.info(
+                            'epoch %d, iter %d, loss %.5f, smoothed loss %.5f, grad norm %.5f, param norm %.5f, batch time %.3f, data wait %.3f, batch size %d, padded context len %d' %
+                            (epoch, global_step, loss, exp_loss, grad_norm, param_norm, iter_time, data_wait, batch.batch_size, batch.context_ids.shape[1]))
+                        write_summary(data_wait, "train/data_wait", summary_writer, global_step)
+
+                    # Sometimes save model
+                    if global_step % self.FLAGS.save_every == 0:
+                        logging.info("Saving to %s..." % checkpoint_path)
+                        self.saver.save(session, checkpoint_path, global_step=global_step)
+
+                    # Sometimes evaluate model on dev loss, train F1/EM and dev F1/EM
+                    # (unless eval_every is 0, e.g. when a separate evaluator process is doing it)
+                    if self.FLAGS.eval_every and global_step % self.FLAGS.eval_every == 0:
+
+                        # Get loss and F1/EM for entire dev set, in one pass
+                        dev_loss, dev_f1, dev_em = self.get_dev_loss_f1_em(session, dev_context_path, dev_qn_path, dev_ans_path)
+                        logging.info("Epoch %d, Iter %d, dev loss: %f" % (epoch, global_step, dev_loss))
+                        write_summary(dev_loss, "dev/loss", summary_writer, global_step)
+
+
+                        # Get F1/EM on train set and log to tensorboard
+                        train_f1, train_em = self.check_f1_em(session, train_context_path, train_qn_path, train_ans_path, "train", num_samples=1000)
+                        logging.info("Epoch %d, Iter %d, Train F1 score: %f, Train EM score: %f" % (epoch, global_step, train_f1, train_em))
+                        write_summary(train_f1, "train/F1", summary_writer, global_step)
+                        write_summary(train_em, "train/EM", summary_writer, global_step)
+
+
+                        # Log dev F1/EM to tensorboard
+                        logging.info("Epoch %d, Iter %d, Dev F1 score: %f, Dev EM score: %f" % (epoch, global_step, dev_f1, dev_em))
+                        write_summary(dev_f1, "dev/F1", summary_writer, global_step)
+                        write_summary(dev_em, "dev/EM", summary_writer, global_step)
+
+
+                        # Early stopping based on dev EM. You could switch this to use F1 instead.
+                        if best_dev_em is None or dev_em > best_dev_em:
+                            best_dev_em = dev_em
+                            logging.info("Saving to %s..." % bestmodel_ckpt_path)
+                            self.bestmodel_saver.save(session, bestmodel_ckpt_path, global_step=global_step)
+
+                    data_tic = time.time()
+            finally:
+                # Stop the prefetching thread, if any, even if training is interrupted
+                if self.FLAGS.prefetch_batches:
+                    batches.close()
 
 
-                    # Get F1/EM on train set and log to tensorboard
-                    train_f1, train_em = self.check_f1_em(session, train_context_path, train_qn_path, train_ans_path, "train", num_samples=1000)
-                    logging.info("Epoch %d, Iter %d, Train F1 score: %f, Train EM score: %f" % (epoch, global_step, train_f1, train_em))
-                    write_summary(train_f1, "train/F1", summary_writer, global_step)
-                    write_summary(train_em, "train/EM", summary_writer, global_step)
+            epoch_toc = time.time()
+            logging.info("End of epoch %i. Time for epoch: %f" % (epoch, epoch_toc-epoch_tic))
 
+        sys.stdout.flush()
 
-                    # Get F1/EM on dev set and log to tensorboard
-                    dev_f1, dev_em = self.check_f1_em(session, dev_context_path, dev_qn_path, dev_ans_path, "dev", num_samples=0)
-                    logging.info("Epoch %d, Iter %d, Dev F1 score: %f, Dev EM score: %f" % (epoch, global_step, dev_f1, dev_em))
-                    write_summary(dev_f1, "dev/F1", summary_writer, global_step)
-                    write_summary(dev_em, "dev/EM", summary_writer, global_step)
 
 
-                    # Early stopping based on dev EM. You could switch this to use F1 instead.
-                    if best_dev_em is None or dev_em > best_dev_em:
-                        best_dev_em = dev_em
-                        logging.info("Saving to %s..." % bestmodel_ckpt_path)
-                        self.bestmodel_saver.save(session, bestmodel_ckpt_path, global_step=global_step)
+def get_ans_len_dist(ans_path):
+    """
+    Reads a .span file (like train.span), and returns a Counter
+    mapping answer length (int) to how many answers have that length.
+    """
+    with open(ans_path, 'r') as f:
+        return collections.Counter(
+            map((lambda t: int(t[1])-int(t[0])+1),
+                (line.strip().split() for line in f)))
 
 
-            epoch_toc = time.time()
-            logging.info("End of epoch %i. Time for epoch: %f" % (epoch, epoch_toc-epoch_tic))
+def write_ans_len_dist(ans_len_dist, path):
+    """Writes an answer length distribution (see get_ans_len_dist) as a .json file"""
+    with open(path, 'w') as f:
+        json.dump(dict((str(l), count) for l, count in ans_len_dist.items()), f, sort_keys=True)
 
-        sys.stdout.flush()
 
+def read_ans_len_dist(path):
+    """Reads an answer length distribution written by write_ans_len_dist"""
+    with open(path, 'r') as f:
+        return collections.Counter(dict((int(l), count) for l, count in json.load(f).items()))
 
 
 def write_summary(value, tag, summary_writer, global_step):
@@ -0,0 +1,102 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file is a load generator for "serve" mode in main.py.
+It sends the (context, question) pairs from a SQuAD JSON file to the server
+from several concurrent clients, and reports latency and throughput, e.g.
+  python code/serve_loadgen.py data/dev-v1.1.json --concurrency=16 --num_requests=2000
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import json
+import time
+import argparse
+import threading
+import itertools
+
+import numpy as np
+from six.moves.urllib.request import Request, urlopen
+
+
+def get_requests(data_filename):
+    """Returns a list of {"context": ..., "question": ...} dictionaries from a SQuAD JSON file"""
+    with open(data_filename) as f:
+        dataset = json.load(f)
+    requests = []
+    for article in dataset['data']:
+        for paragraph in article['paragraphs']:
+            for qn in paragraph['qas']:
+                requests.append({"context": paragraph['context'], "question": qn['question']})
+    return requests
+
+
+def post_json(url, obj):
+    request = Request(url, json.dumps(obj).encode('utf-8'), {"Content-Type": "application/json"})
+    return json.loads(urlopen(request).read().decode('utf-8'))
+
+
+def run_client(url, request_iter, lock, latencies, errors):
+    """Sends requests from request_iter (shared between clients) one at a time until it runs out"""
+    while True:
+        with lock:
+            request = next(request_iter, None)
+        if request is None:
+            return
+        tic = time.time()
+        try:
+            post_json(url + "/answer", request)
+        except Exception as e:
+            with lock:
+                errors.append(str(e))
+            continue
+        with lock:
+            latencies.append(time.time() - tic)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for main.py --mode=serve")
+    parser.add_argument("data_file", help="SQuAD JSON file to take contexts and questions from")
+    parser.add_argument("--url", default="http://localhost:8000", help="Server address")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of concurrent clients")
+    parser.add_argument("--num_requests", type=int, default=1000, help="Total number of requests to send (cycling through the data file)")
+    args = parser.parse_args()
+
+    requests = get_requests(args.data_file)
+    request_iter = itertools.islice(itertools.cycle(requests), args.num_requests)
+    lock = threading.Lock()
+    latencies, errors = [], []
+
+    print "Sending %i requests to %s from %i clients..." % (args.num_requests, args.url, args.concurrency)
+    tic = time.time()
+    clients = [threading.Thread(target=run_client, args=(args.url, request_iter, lock, latencies, errors)) for _ in range(args.concurrency)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - tic
+
+    latencies = np.array(latencies) * 1000.
+    print "Completed %i requests (%i errors) in %.2f seconds: %.1f requests/sec" % (len(latencies), len(errors), elapsed, len(latencies) / elapsed)
+    if len(latencies):
+        print "Client latency: p50 %.1f ms, p99 %.1f ms, max %.1f ms" % (np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max())
+    if errors:
+        print "First error: %s" % errors[0]
+
+    print "Server stats: %s" % json.dumps(json.loads(urlopen(args.url + "/stats").read().decode('utf-8')), sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This code is required for "serve" mode in main.py
+It runs a local HTTP server that answers (context, question) requests with a loaded model.
+Concurrent requests are coalesced into batches by a MicroBatcher.
+
+Endpoints:
+  POST /answer with a JSON object {"context": ..., "question": ...}
+    returns {"answer": ...}
+  GET /stats
+    returns latency and throughput statistics (see MicroBatcher.stats)
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import sys
+import json
+import time
+import threading
+import collections
+
+import numpy as np
+from six.moves import queue
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.socketserver import ThreadingMixIn
+from nltk.tokenize.moses import MosesDetokenizer
+
+from preprocessing.squad_preprocess import tokenize
+from official_eval_helper import tokenize_context, make_batch, get_answer_text
+
+
+class Request(object):
+    """A single (context, question) request, waiting for its answer"""
+
+    def __init__(self, context_tokens, qn_tokens):
+        self.context_tokens = context_tokens
+        self.qn_tokens = qn_tokens
+        self.arrival_time = time.time()
+        self.answer = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """
+    Runs the model in a single worker thread, on batches of concurrent requests.
+
+    The worker waits for a request, then keeps collecting requests until it has max_batch_size of them
+    or max_wait_ms has passed since the first one arrived, and runs them as one batch.
+    So under light load a request waits at most max_wait_ms before it's run,
+    and under heavy load the batches fill up.
+    """
+
+    def __init__(self, session, model, word2id, max_batch_size, max_wait_ms, num_latencies=10000):
+        """
+        Inputs:
+          session: TensorFlow session, with the model loaded
+          model: QAModel
+          word2id: dictionary mapping word (string) to word id (int)
+          max_batch_size: int. Max number of requests per batch
+          max_wait_ms: float. Max time to wait for a batch to fill up
+          num_latencies: int. How many of the most recent request latencies to keep for stats
+        """
+        self.session = session
+        self.model = model
+        self.word2id = word2id
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.detokenizer = MosesDetokenizer()
+
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=num_latencies)
+        self._start_time = time.time()
+        self._num_requests = 0
+        self._num_batches = 0
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def answer(self, context_tokens, qn_tokens):
+        """Submits a request and waits for the answer (a detokenized string). Called from the server threads."""
+        request = Request(context_tokens, qn_tokens)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.answer
+
+    def _next_batch(self):
+        """Waits for the next request, then collects requests until the batch is full or max_wait has passed"""
+        requests = [self._queue.get()]
+        deadline = requests[0].arrival_time + self.max_wait
+        while len(requests) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    requests.append(self._queue.get(timeout=timeout))
+                else:
+                    # Past the deadline, but still take any requests that are already waiting
+                    requests.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return requests
+
+    def _run(self):
+        """The worker thread"""
+        while True:
+            requests = self._next_batch()
+            try:
+                self._answer_batch(requests)
+            except Exception as e:
+                for request in requests:
+                    request.error = e
+
+            now = time.time()
+            with self._stats_lock:
+                self._latencies.extend(now - request.arrival_time for request in requests)
+                self._num_requests += len(requests)
+                self._num_batches += 1
+            for request in requests:
+                request.done.set()
+
+    def _answer_batch(self, requests):
+        """Runs the model on a batch of requests, and sets their answers"""
+        flags = self.model.FLAGS
+        uuids = range(len(requests))
+        context_tokens = [request.context_tokens for request in requests]
+        qn_tokens = [request.qn_tokens for request in requests]
+        batch = make_batch(self.word2id, uuids, context_tokens, qn_tokens, flags.context_len, flags.question_len, pad_to_batch_max=True, dedup=flags.dedup_contexts)
+
+        pred_start_batch, pred_end_batch = self.model.get_start_end_pos(self.session, batch)
+
+        for request, pred_start, pred_end in zip(requests, pred_start_batch.tolist(), pred_end_batch.tolist()):
+            request.answer = get_answer_text(request.context_tokens, pred_start, pred_end, self.detokenizer)
+
+    def stats(self):
+        """
+        Returns a dictionary of statistics since the server started:
+          num_requests, num_batches, mean_batch_size, throughput (requests/sec),
+          and p50_latency_ms, p99_latency_ms over the most recent requests
+        """
+        with self._stats_lock:
+            latencies = np.array(self._latencies) * 1000.
+            num_requests, num_batches = self._num_requests, self._num_batches
+        elapsed = time.time() - self._start_time
+
+        stats = {
+            "num_requests": num_requests,
+            "num_batches": num_batches,
+            "mean_batch_size": num_requests / num_batches if num_batches else 0.,
+            "throughput": num_requests / elapsed,
+        }
+        if len(latencies):
+            stats["p50_latency_ms"] = float(np.percentile(latencies, 50))
+            stats["p99_latency_ms"] = float(np.percentile(latencies, 99))
+        if self.model.context_cache is not None:
+            stats["context_cache"] = self.model.context_cache.stats()
+        return stats
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """Handles each HTTP request in its own thread, so that concurrent requests can be batched together"""
+    daemon_threads = True
+
+
+class QAHandler(BaseHTTPRequestHandler):
+    """HTTP request handler. self.server.batcher is the MicroBatcher"""
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.batcher.stats())
+        else:
+            self.send_json(404, {"error": "Unknown path %s" % self.path})
+
+    def do_POST(self):
+        if self.path != "/answer":
+            self.send_json(404, {"error": "Unknown path %s" % self.path})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            context_tokens = tokenize_context(unicode(request["context"]))
+            qn_tokens = tokenize(unicode(request["question"]))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": "Expected a JSON object with context and question: %s" % e})
+            return
+        if not context_tokens or not qn_tokens:
+            self.send_json(400, {"error": "Empty context or question"})
+            return
+
+        try:
+            answer = self.server.batcher.answer(context_tokens, qn_tokens)
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"answer": answer})
+
+    def log_message(self, format, *args):
+        pass # don't log every request
+
+
+def serve(session, model, word2id, host, port, max_batch_size, max_wait_ms, stats_every=60):
+    """
+    Runs the HTTP server until interrupted, printing stats every stats_every seconds.
+
+    Inputs:
+      session: TensorFlow session, with the model loaded
+      model: QAModel
+      word2id: dictionary mapping word (string) to word id (int)
+      host, port: address to listen on
+      max_batch_size, max_wait_ms: batching policy (see MicroBatcher)
+      stats_every: int. How often to print stats, in seconds
+    """
+    server = ThreadingHTTPServer((host, port), QAHandler)
+    server.batcher = MicroBatcher(session, model, word2id, max_batch_size, max_wait_ms)
+
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    print "Serving on http://%s:%i (max batch size %i, max wait %.1f ms)" % (host, port, max_batch_size, max_wait_ms)
+    sys.stdout.flush()
+
+    try:
+        while server_thread.is_alive():
+            server_thread.join(stats_every)
+            print "Server stats: %s" % json.dumps(server.batcher.stats(), sort_keys=True)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        print "Shutting down server"
+    finally:
+        server.shutdown()
+        server.server_close()
+        print "Final server stats: %s" % json.dumps(server.batcher.stats(), sort_keys=True)
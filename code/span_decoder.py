@@ -0,0 +1,138 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""This file contains functions to decode the most likely answer span
+from the start and end probability distributions output by the model"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def decode_dense(start_dist, end_dist, ans_len_prior):
+    """
+    Reference decoder. Scores every (start, end) pair by materialising
+    the outer product of the start and end distributions for each example.
+
+    Inputs:
+      start_dist, end_dist: numpy arrays shape (batch_size, context_len)
+      ans_len_prior: numpy array shape (context_len, context_len).
+        Entry [start, end] is the prior probability of that span (0 where end < start).
+
+    Returns:
+      start_pos, end_pos: both numpy arrays shape (batch_size)
+    """
+    context_len = start_dist.shape[1]
+    range_dist = np.array([(np.outer(S, E) * ans_len_prior).flatten()
+            for S, E in zip(start_dist, end_dist)])
+    locations = np.argmax(range_dist, axis=1)
+    start_pos = locations // context_len
+    end_pos = locations % context_len
+    return start_pos, end_pos
+
+
+def decode_band(start_dist, end_dist, ans_len_probs, max_answer_len):
+    """
+    Band-limited decoder. Only scores spans with end >= start and
+    length <= max_answer_len, vectorised across the whole batch.
+    This is O(batch_size * context_len * max_answer_len) rather than
+    O(batch_size * context_len^2), and gives the same result as decode_dense
+    when max_answer_len >= context_len.
+
+    Inputs:
+      start_dist, end_dist: numpy arrays shape (batch_size, context_len)
+      ans_len_probs: numpy array shape (>= max_answer_len).
+        Entry i is the prior probability of an answer of length i+1.
+      max_answer_len: int. Longest span to consider. If 0, consider all lengths.
+
+    Returns:
+      start_pos, end_pos: both numpy arrays shape (batch_size)
+    """
+    batch_size, context_len = start_dist.shape
+    max_len = min(max_answer_len, context_len) if max_answer_len > 0 else context_len
+
+    # View end_dist as windows of length max_len starting at each position,
+    # so that end_windows[b, s, k] = end_dist[b, s+k]. The padding only
+    # exists so that windows near the end of the context stay in bounds.
+    end_padded = np.zeros((batch_size, context_len + max_len - 1), dtype=end_dist.dtype)
+    end_padded[:, :context_len] = end_dist
+    stride_b, stride_i = end_padded.strides
+    end_windows = as_strided(end_padded, shape=(batch_size, context_len, max_len), strides=(stride_b, stride_i, stride_i))
+
+    # scores[b, s, k] is the score of the span (s, s+k). shape (batch_size, context_len, max_len)
+    # (the prior is cast to the distributions' dtype, so the scores aren't upcast to float64)
+    len_probs = ans_len_probs[:max_len].astype(start_dist.dtype)
+    scores = start_dist[:, :, np.newaxis] * end_windows * len_probs[np.newaxis, np.newaxis, :]
+
+    # Spans that run off the end of the context can never be chosen
+    out_of_range = (np.arange(context_len)[:, np.newaxis] + np.arange(max_len)[np.newaxis, :]) >= context_len # shape (context_len, max_len)
+    scores[:, out_of_range] = -1.
+
+    locations = np.argmax(scores.reshape(batch_size, -1), axis=1)
+    start_pos = locations // max_len
+    end_pos = start_pos + locations % max_len
+    return start_pos, end_pos
+
+
+def best_span_per_length(start_dist, end_dist, max_answer_len):
+    """
+    For each example and each answer length, finds the best start position and its score
+    (without any answer-length prior), i.e. max over s of start_dist[s] * end_dist[s+k]
+    for the length k+1. The best span for any prior over lengths up to max_answer_len
+    can then be found with decode_best_per_length, without looking at the distributions again.
+
+    Inputs:
+      start_dist, end_dist: numpy arrays shape (batch_size, context_len)
+      max_answer_len: int. Longest span to consider. If 0, consider all lengths.
+
+    Returns:
+      best_starts: numpy array shape (batch_size, max_len) of ints.
+        Entry [b, k] is the best start position for an answer of length k+1.
+      best_scores: numpy array shape (batch_size, max_len). The score of that span.
+    """
+    batch_size, context_len = start_dist.shape
+    max_len = min(max_answer_len, context_len) if max_answer_len > 0 else context_len
+
+    best_starts = np.zeros((batch_size, max_len), dtype=np.int64)
+    best_scores = np.zeros((batch_size, max_len), dtype=start_dist.dtype)
+    batch_idxs = np.arange(batch_size)
+    for k in xrange(max_len):
+        scores = start_dist[:, :context_len-k] * end_dist[:, k:] # scores of the spans (s, s+k). shape (batch_size, context_len-k)
+        best_starts[:, k] = np.argmax(scores, axis=1)
+        best_scores[:, k] = scores[batch_idxs, best_starts[:, k]]
+    return best_starts, best_scores
+
+
+def decode_best_per_length(best_starts, log_best_scores, log_ans_len_probs):
+    """
+    Decodes the most likely answer spans from the output of best_span_per_length.
+    Gives the same spans as decode_band (with the same max_answer_len) up to ties.
+
+    Inputs:
+      best_starts: numpy array shape (batch_size, max_len), from best_span_per_length
+      log_best_scores: numpy array shape (batch_size, max_len). The log of best_scores
+        from best_span_per_length (-inf for lengths that shouldn't be chosen).
+      log_ans_len_probs: numpy array shape (>= max_len).
+        Entry i is the log prior probability of an answer of length i+1.
+
+    Returns:
+      start_pos, end_pos: both numpy arrays shape (batch_size)
+    """
+    batch_size, max_len = best_starts.shape
+    lengths = np.argmax(log_best_scores + log_ans_len_probs[np.newaxis, :max_len], axis=1) # answer length - 1
+    start_pos = best_starts[np.arange(batch_size), lengths]
+    end_pos = start_pos + lengths
+    return start_pos, end_pos
@@ -0,0 +1,85 @@
+# Copyright 2018 Stanford University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for span_decoder.py. Run with
+  python code/span_decoder_test.py
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+
+import unittest
+
+import numpy as np
+
+from span_decoder import decode_dense, decode_band, best_span_per_length, decode_best_per_length
+
+
+def random_dists(rng, batch_size, context_len):
+    """Returns random start and end distributions, both shape (batch_size, context_len)"""
+    start_dist = rng.rand(batch_size, context_len)
+    end_dist = rng.rand(batch_size, context_len)
+    return start_dist / start_dist.sum(axis=1, keepdims=True), end_dist / end_dist.sum(axis=1, keepdims=True)
+
+
+def ans_len_prior(ans_len_probs, context_len, max_answer_len=0):
+    """Returns the (context_len, context_len) prior for decode_dense, for the given answer-length probabilities"""
+    prior = np.zeros((context_len, context_len))
+    for start in range(context_len):
+        for end in range(start, context_len):
+            if max_answer_len == 0 or end - start < max_answer_len:
+                prior[start, end] = ans_len_probs[end - start]
+    return prior
+
+
+class SpanDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0)
+        self.batch_size, self.context_len = 16, 30
+        self.start_dist, self.end_dist = random_dists(self.rng, self.batch_size, self.context_len)
+        base_probs = self.rng.rand(self.context_len) + 0.01
+        self.base_probs = base_probs / base_probs.sum()
+
+    def test_band_matches_dense(self):
+        for max_answer_len in [0, 1, 7, self.context_len]:
+            ans_len_probs = self.base_probs
+            expected = decode_dense(self.start_dist, self.end_dist, ans_len_prior(ans_len_probs, self.context_len, max_answer_len))
+            actual = decode_band(self.start_dist, self.end_dist, ans_len_probs, max_answer_len)
+            np.testing.assert_array_equal(expected[0], actual[0])
+            np.testing.assert_array_equal(expected[1], actual[1])
+
+    def test_best_per_length_matches_dense(self):
+        best_starts, best_scores = best_span_per_length(self.start_dist, self.end_dist, 0)
+        for power in [0., 0.25, 1., 3.]:
+            ans_len_probs = self.base_probs ** power
+            expected = decode_dense(self.start_dist, self.end_dist, ans_len_prior(ans_len_probs, self.context_len))
+            actual = decode_best_per_length(best_starts, np.log(best_scores), np.log(ans_len_probs))
+            np.testing.assert_array_equal(expected[0], actual[0])
+            np.testing.assert_array_equal(expected[1], actual[1])
+
+    def test_best_per_length_matches_band(self):
+        max_answer_len = 5
+        best_starts, best_scores = best_span_per_length(self.start_dist, self.end_dist, max_answer_len)
+        self.assertEqual(best_starts.shape, (self.batch_size, max_answer_len))
+        for power in [0., 0.5, 2.]:
+            ans_len_probs = self.base_probs ** power
+            expected = decode_band(self.start_dist, self.end_dist, ans_len_probs, max_answer_len)
+            actual = decode_best_per_length(best_starts, np.log(best_scores), np.log(ans_len_probs))
+            np.testing.assert_array_equal(expected[0], actual[0])
+            np.testing.assert_array_equal(expected[1], actual[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
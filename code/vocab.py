@@ -18,8 +18,11 @@ and return them as an embedding matrix"""
 from __future__ import absolute_import
 from __future__ import division
 
+import os
+
 from tqdm import tqdm
 import numpy as np
+from six.moves import xrange
 
 _PAD = b"<pad>"
 _UNK = b"<unk>"
@@ -32,6 +35,10 @@ def get_glove(glove_path, glove_dim):
     """Reads from original GloVe .txt file and returns embedding matrix and
     mappings from words to word ids.
 
+    The first time a GloVe file is read, the embedding matrix (float32) and the
+    vocab are written to a binary cache next to it (see get_glove_cache_paths).
+    Later calls load the cache with np.load(mmap_mode='r') instead of parsing the text file.
+
     Input:
       glove_path: path to glove.6B.{glove_dim}d.txt
       glove_dim: integer; needs to match the dimension in glove_path
@@ -43,11 +50,74 @@ def get_glove(glove_path, glove_dim):
       word2id: dictionary mapping word (string) to word id (int)
       id2word: dictionary mapping word id (int) to word (string)
     """
+    emb_path, vocab_path = get_glove_cache_paths(glove_path)
+    if is_glove_cache_fresh(glove_path, emb_path, vocab_path):
+        return load_glove_cache(emb_path, vocab_path, glove_path, glove_dim)
+
+    emb_matrix, word2id, id2word = read_glove_txt(glove_path, glove_dim)
+    write_glove_cache(emb_matrix, id2word, emb_path, vocab_path)
+
+    return emb_matrix, word2id, id2word
+
+
+def get_glove_cache_paths(glove_path):
+    """Given path to glove.6B.{glove_dim}d.txt, returns the paths of the
+    binary cache: glove.6B.{glove_dim}d.npy (embedding matrix) and
+    glove.6B.{glove_dim}d.vocab (one word per line, in word id order)"""
+    base_path = os.path.splitext(glove_path)[0]
+    return base_path + ".npy", base_path + ".vocab"
+
+
+def is_glove_cache_fresh(glove_path, emb_path, vocab_path):
+    """Returns True if the binary cache exists and is at least as new as the GloVe .txt file (if any)"""
+    if not (os.path.exists(emb_path) and os.path.exists(vocab_path)):
+        return False
+    if not os.path.exists(glove_path):
+        return True
+    glove_mtime = os.path.getmtime(glove_path)
+    return os.path.getmtime(emb_path) >= glove_mtime and os.path.getmtime(vocab_path) >= glove_mtime
+
+
+def load_glove_cache(emb_path, vocab_path, glove_path, glove_dim):
+    """Loads the embedding matrix (memory-mapped, read-only) and vocab mappings written by write_glove_cache"""
+    print "Loading GLoVE vectors from cache: %s" % emb_path
+    emb_matrix = np.load(emb_path, mmap_mode='r')
+    if emb_matrix.shape[1] != glove_dim:
+        raise Exception("You set --glove_path=%s but --embedding_size=%i. If you set --glove_path yourself then make sure that --embedding_size matches!" % (glove_path, glove_dim))
+
+    words = read_vocab(vocab_path)
+    if len(words) != emb_matrix.shape[0]:
+        raise Exception("GloVe cache at %s is inconsistent with %s. Delete both to rebuild the cache." % (vocab_path, emb_path))
+
+    word2id = dict(zip(words, xrange(len(words))))
+    id2word = dict(enumerate(words))
+    assert len(word2id) == len(words)
+
+    return emb_matrix, word2id, id2word
+
+
+def write_glove_cache(emb_matrix, id2word, emb_path, vocab_path):
+    """Writes the binary cache read by load_glove_cache.
+    If the cache can't be written (e.g. read-only data dir) we just carry on without it."""
+    try:
+        # Write to temporary files first so that an interrupted write never leaves a partial cache
+        with open(emb_path + ".tmp", 'wb') as fh:
+            np.save(fh, emb_matrix)
+        write_vocab(id2word, vocab_path + ".tmp")
+        os.rename(emb_path + ".tmp", emb_path)
+        os.rename(vocab_path + ".tmp", vocab_path)
+        print "Wrote GLoVE cache to %s" % emb_path
+    except (IOError, OSError) as e:
+        print "Unable to write GLoVE cache to %s: %s" % (emb_path, e)
+
+
+def read_glove_txt(glove_path, glove_dim):
+    """Parses the original GloVe .txt file. See get_glove for inputs and outputs."""
 
     print "Loading GLoVE vectors from file: %s" % glove_path
     vocab_size = int(4e5) # this is the vocab size of the corpus we've downloaded
 
-    emb_matrix = np.zeros((vocab_size + len(_START_VOCAB), glove_dim))
+    emb_matrix = np.zeros((vocab_size + len(_START_VOCAB), glove_dim), dtype=np.float32)
     word2id = {}
     id2word = {}
 
@@ -82,3 +152,65 @@ def get_glove(glove_path, glove_dim):
     assert idx == final_vocab_size
 
     return emb_matrix, word2id, id2word
+
+
+def get_restricted_words(word2id, data_paths, top_n=0):
+    """Returns the words to keep when restricting the vocab to a dataset.
+
+    Inputs:
+      word2id: dictionary mapping word (string) to word id (int), as returned by get_glove
+      data_paths: list of paths to tokenized data files (e.g. {train/dev}.{context/question})
+      top_n: int. Also keep the top_n most frequent GloVe words
+        (the GloVe file is sorted by frequency, so these are the first top_n words after PAD and UNK).
+
+    Returns:
+      words: list of words (strings) in word id order, starting with PAD and UNK.
+        Only words that have a GloVe vector are kept; anything else would be UNK anyway.
+    """
+    keep_ids = set(xrange(min(len(_START_VOCAB) + top_n, len(word2id))))
+    for data_path in data_paths:
+        with open(data_path, 'r') as fh:
+            for line in fh:
+                for word in line.split():
+                    idx = word2id.get(word)
+                    if idx is not None:
+                        keep_ids.add(idx)
+
+    id2word = dict((idx, word) for word, idx in word2id.iteritems())
+    return [id2word[idx] for idx in sorted(keep_ids)]
+
+
+def restrict_vocab(emb_matrix, word2id, words):
+    """Restricts the embedding matrix and vocab mappings to the given words.
+    Any word that isn't kept will be mapped to UNK, like any other out-of-vocab word.
+
+    Inputs:
+      emb_matrix, word2id: as returned by get_glove
+      words: list of words (strings) to keep, starting with PAD and UNK. Their position in
+        the list becomes their new word id.
+
+    Returns:
+      emb_matrix: Numpy array shape (len(words), glove_dim)
+      word2id, id2word: the new mappings
+    """
+    assert words[:len(_START_VOCAB)] == _START_VOCAB
+    missing = [word for word in words if word not in word2id]
+    if missing:
+        raise Exception("Restricted vocab contains %i words without a GloVe vector, e.g. %s. Was it built from a different GloVe file?" % (len(missing), missing[0]))
+
+    emb_matrix = np.array(emb_matrix[[word2id[word] for word in words]])
+    word2id = dict(zip(words, xrange(len(words))))
+    id2word = dict(enumerate(words))
+    return emb_matrix, word2id, id2word
+
+
+def write_vocab(id2word, vocab_path):
+    """Writes the words in id2word to file, one per line, in word id order"""
+    with open(vocab_path, 'w') as fh:
+        fh.write("\n".join(id2word[idx] for idx in xrange(len(id2word))))
+
+
+def read_vocab(vocab_path):
+    """Reads a list of words written by write_vocab"""
+    with open(vocab_path, 'r') as fh:
+        return fh.read().split("\n")